@@ -0,0 +1,178 @@
+import sqlite3
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from statistics import median
+from typing import Any, Dict, Iterator, List, Optional
+
+from .config import get_state_dir
+
+# Number of most recent runs compared against the older ones for trends
+TREND_WINDOW = 5
+
+# Number of most recent runs to look for the slowest runs in
+RECENT_RUNS = 50
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    operation TEXT NOT NULL,
+    strategy TEXT NOT NULL,
+    database TEXT NOT NULL,
+    started_at TEXT NOT NULL,
+    duration REAL NOT NULL,
+    snapshot_name TEXT,
+    bytes INTEGER,
+    server_version TEXT,
+    succeeded INTEGER NOT NULL
+)
+"""
+
+
+@dataclass
+class Run:
+    """
+    A single timed run of an operation
+    """
+
+    operation: str
+    strategy: str
+    database: str
+    started_at: datetime
+    duration: float = 0.0
+    snapshot_name: Optional[str] = None
+    bytes: Optional[int] = None
+    server_version: Optional[str] = None
+    succeeded: bool = False
+
+    @property
+    def throughput(self) -> Optional[float]:
+        """
+        Bytes per second, if known
+        """
+        if not self.bytes or not self.duration:
+            return None
+
+        return self.bytes / self.duration
+
+
+@contextmanager
+def connect() -> Iterator[sqlite3.Connection]:
+    """
+    Opens the history database, creating it if needed
+
+    Changes are committed when the block exits without errors.
+    """
+    conn = sqlite3.connect(get_state_dir() / "history.sqlite3")
+
+    try:
+        with conn:
+            conn.execute(SCHEMA)
+            yield conn
+    finally:
+        conn.close()
+
+
+def record_run(run: Run):
+    """
+    Appends the given run to the history
+    """
+    row = asdict(run)
+    row["started_at"] = run.started_at.isoformat()
+
+    with connect() as conn:
+        conn.execute(
+            """
+            INSERT INTO runs VALUES (
+                :operation, :strategy, :database, :started_at, :duration,
+                :snapshot_name, :bytes, :server_version, :succeeded
+            )
+            """,
+            row,
+        )
+
+
+def get_runs() -> List[Run]:
+    """
+    Returns all successful runs, oldest first
+    """
+    with connect() as conn:
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute(
+            "SELECT * FROM runs WHERE succeeded ORDER BY started_at"
+        ).fetchall()
+
+    return [
+        Run(
+            **{
+                **dict(row),
+                "started_at": datetime.fromisoformat(row["started_at"]),
+                "succeeded": bool(row["succeeded"]),
+            }
+        )
+        for row in rows
+    ]
+
+
+def percentile(values: List[float], p: float) -> float:
+    """
+    Returns the p-th percentile of the given values, interpolating between the
+    closest ranks
+    """
+    values = sorted(values)
+    rank = (len(values) - 1) * p / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+def summarize(runs: List[Run]) -> Dict[str, Any]:
+    """
+    Returns duration percentiles and throughput figures for the given runs of
+    a single operation
+
+    The trend compares the median throughput of the most recent runs with that
+    of the ones before them.
+    """
+    durations = [run.duration for run in runs]
+    throughputs = [run.throughput for run in runs if run.throughput]
+    recent = throughputs[-TREND_WINDOW:]
+    previous = throughputs[:-TREND_WINDOW]
+
+    return {
+        "runs": len(runs),
+        "p50": percentile(durations, 50),
+        "p90": percentile(durations, 90),
+        "p99": percentile(durations, 99),
+        "throughput": median(throughputs) if throughputs else None,
+        "trend": (
+            median(recent) / median(previous) - 1 if recent and previous else None
+        ),
+    }
+
+
+def get_stats(slowest: int = 5) -> Dict[str, Any]:
+    """
+    Returns per database and operation summaries of the history, along with
+    the slowest recent runs
+    """
+    runs = get_runs()
+    groups: Dict[str, Dict[str, List[Run]]] = {}
+
+    for run in runs:
+        groups.setdefault(run.database, {}).setdefault(run.operation, []).append(run)
+
+    # Only look at the latest runs so that old outliers eventually drop off
+    slowest_runs = sorted(runs[-RECENT_RUNS:], key=lambda r: r.duration, reverse=True)
+
+    return {
+        "operations": [
+            {"database": database, "operation": operation, **summarize(group)}
+            for database, operations in sorted(groups.items())
+            for operation, group in sorted(operations.items())
+        ],
+        "slowest": [
+            {**asdict(run), "started_at": run.started_at.isoformat()}
+            for run in slowest_runs[:slowest]
+        ],
+    }
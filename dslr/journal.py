@@ -0,0 +1,65 @@
+import json
+import os
+import threading
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import List, Optional
+
+from .config import get_state_dir
+
+# Steps may be completed from several threads at once during parallel imports
+journal_lock = threading.Lock()
+
+
+@dataclass
+class ImportJournal:
+    """
+    Records the progress of a resumable import
+
+    Each step of the import (a section of the dump or a single table of
+    contents entry) is recorded once it has been committed, so that a failed
+    import can pick up where it left off.
+    """
+
+    snapshot_name: str
+    import_path: str
+    dbname: str
+    completed: List[str] = field(default_factory=list)
+
+    @staticmethod
+    def get_path(snapshot_name: str) -> Path:
+        return get_state_dir() / "imports" / f"{snapshot_name}.json"
+
+    @classmethod
+    def load(cls, snapshot_name: str) -> Optional["ImportJournal"]:
+        """
+        Returns the journal of the unfinished import of the given snapshot
+        """
+        try:
+            with open(cls.get_path(snapshot_name)) as f:
+                return cls(**json.load(f))
+        except FileNotFoundError:
+            return None
+
+    def save(self):
+        path = self.get_path(self.snapshot_name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write to a temporary file first so that a crash never leaves a
+        # truncated journal behind
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(asdict(self), f)
+
+        os.replace(tmp_path, path)
+
+    def is_completed(self, step: str) -> bool:
+        return step in self.completed
+
+    def complete(self, step: str):
+        with journal_lock:
+            self.completed.append(step)
+            self.save()
+
+    def discard(self):
+        self.get_path(self.snapshot_name).unlink(missing_ok=True)
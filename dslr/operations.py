@@ -1,6 +1,19 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
 from collections import namedtuple
-from datetime import datetime
-from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from fnmatch import fnmatchcase
+from functools import partial
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 try:
     from psycopg import sql
@@ -8,41 +21,288 @@ except ImportError:
     from psycopg2 import sql
 
 from .config import settings
-from .runner import exec_shell, exec_sql
+from .console import console
+from .history import Run, record_run
+from .journal import ImportJournal
+from .pg_client import PGClient
+from .runner import (
+    advisory_unlock,
+    connect_pgbouncer,
+    db_session,
+    exec_shell,
+    exec_sql,
+    pgbouncer_session,
+    try_advisory_lock,
+)
 
 ################################################################################
 # Database operations
 ################################################################################
 
 
+# Hosts that mean the server is running on this machine
+LOCAL_HOSTS = ("", "localhost", "127.0.0.1", "::1")
+
+
+# How long to wait for terminated connections to go away, and how often to check
+CONNECTION_EXIT_TIMEOUT = 30
+CONNECTION_EXIT_POLL_INTERVAL = 0.1
+
+
 def kill_connections(dbname: str):
     """
-    Kills all connections to the given database
+    Kills all connections to the given database and waits for them to exit
+
+    pg_terminate_backend only signals the server processes, which then still
+    have to finish up (e.g. report their statistics) before they're gone.
+    Clients that reconnect in the meantime are terminated as well.
     """
-    exec_sql(
+    deadline = time.monotonic() + CONNECTION_EXIT_TIMEOUT
+
+    while exec_sql(
         "SELECT pg_terminate_backend(pg_stat_activity.pid) FROM pg_stat_activity "
         "WHERE pg_stat_activity.datname = %s",
         [dbname],
-    )
+    ):
+        if time.monotonic() > deadline:
+            raise RuntimeError(
+                f"Timed out waiting for connections to {dbname} to exit."
+            )
+
+        time.sleep(CONNECTION_EXIT_POLL_INTERVAL)
+
+
+def quote_pgbouncer_identifier(name: str) -> str:
+    """
+    Quotes a database name for use in a PgBouncer admin console command
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+
+def pause_pgbouncer(dbname: str) -> PGClient:
+    """
+    Pauses the given database in PgBouncer and returns the admin connection
+    that paused it
+
+    PAUSE only returns once every server connection has been released, which
+    never happens while a client holds on to a session. If that takes longer
+    than the `pgbouncer_pause_timeout` setting, the pause is called off with a
+    RESUME from a second connection and a RuntimeError is raised. The admin
+    connection that's still waiting can't be interrupted, so it's left to close
+    when the process exits.
+    """
+    database = quote_pgbouncer_identifier(dbname)
+    client = connect_pgbouncer()
+    done = threading.Event()
+    errors: List[Exception] = []
+
+    def pause():
+        try:
+            client.execute(f"PAUSE {database}", None)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            done.set()
+
+    threading.Thread(target=pause, daemon=True).start()
+
+    if not done.wait(settings.pgbouncer_pause_timeout):
+        with pgbouncer_session() as other_client:
+            other_client.execute(f"RESUME {database}", None)
+
+        raise RuntimeError(
+            f"Timed out waiting for PgBouncer to pause {dbname}. Is a client "
+            "holding on to a session?"
+        )
+
+    if errors:
+        client.close()
+        raise errors[0]
+
+    return client
+
+
+@contextmanager
+def quiesce(dbname: str) -> Iterator[None]:
+    """
+    Makes sure nothing is connected to the given database while the block runs
+
+    Other connections are terminated, unless the `pgbouncer_admin_url` setting
+    is set. In that case, the database is paused in PgBouncer first, which waits
+    for the pooled server connections to be released and makes clients wait
+    instead of erroring out. Connections that bypass PgBouncer are still
+    terminated. The database is resumed when the block exits.
+    """
+    if not settings.pgbouncer:
+        kill_connections(dbname)
+        yield
+        return
+
+    client = pause_pgbouncer(dbname)
+
+    try:
+        kill_connections(dbname)
+        yield
+    finally:
+        try:
+            client.execute(f"RESUME {quote_pgbouncer_identifier(dbname)}", None)
+        finally:
+            client.close()
 
 
-def create_database(*, dbname: str, template: Optional[str] = None):
+def create_database(
+    *, dbname: str, template: Optional[str] = None, tablespace: Optional[str] = None
+):
     """
-    Creates a new database with the given name, optionally using the given template
+    Creates a new database with the given name, optionally using the given
+    template and tablespace
     """
+    query = sql.SQL("CREATE DATABASE {}").format(sql.Identifier(dbname))
+
     if template:
-        exec_sql(
-            sql.SQL("CREATE DATABASE {} TEMPLATE {}").format(
-                sql.Identifier(dbname),
-                sql.Identifier(template),
-            )
+        query += sql.SQL(" TEMPLATE {}").format(sql.Identifier(template))
+
+    if tablespace:
+        query += sql.SQL(" TABLESPACE {}").format(sql.Identifier(tablespace))
+
+    exec_sql(query)
+
+
+def database_exists(dbname: str) -> bool:
+    """
+    Returns whether a database with the given name exists
+    """
+    return bool(exec_sql("SELECT 1 FROM pg_database WHERE datname = %s", [dbname]))
+
+
+def get_database_tablespace(dbname: str) -> Optional[str]:
+    """
+    Returns the name of the default tablespace of the given database
+    """
+    result = exec_sql(
+        """
+        SELECT pg_tablespace.spcname
+        FROM pg_database
+        JOIN pg_tablespace ON pg_tablespace.oid = pg_database.dattablespace
+        WHERE pg_database.datname = %s
+        """,
+        [dbname],
+    )
+
+    if not result:
+        return None
+
+    return result[0][0]
+
+
+def parse_database_metadata(comment: Optional[str]) -> Dict[str, Any]:
+    """
+    Parses the metadata DSLR keeps in a database's comment
+    """
+    try:
+        metadata = json.loads(comment or "{}")
+    except ValueError:
+        return {}
+
+    return metadata if isinstance(metadata, dict) else {}
+
+
+def set_database_metadata(dbname: str, metadata: Dict[str, Any]):
+    """
+    Stores the given metadata in the database's comment
+
+    Comments belong to the database itself, so they follow it when it's renamed
+    but aren't copied when it's used as a template.
+    """
+    exec_sql(
+        sql.SQL("COMMENT ON DATABASE {} IS {}").format(
+            sql.Identifier(dbname), sql.Literal(json.dumps(metadata))
         )
-    else:
-        exec_sql(
-            sql.SQL("CREATE DATABASE {}").format(
-                sql.Identifier(dbname),
-            )
+    )
+
+
+def rename_database(dbname: str, new_dbname: str):
+    """
+    Renames the given database
+    """
+    exec_sql(
+        sql.SQL("ALTER DATABASE {} RENAME TO {}").format(
+            sql.Identifier(dbname),
+            sql.Identifier(new_dbname),
         )
+    )
+
+
+def generate_temp_db_name(purpose: str) -> str:
+    """
+    Generates a name for a database that DSLR only needs while an operation runs
+
+    These don't follow the snapshot naming convention, so they never show up as
+    snapshots.
+    """
+    return f"tmp_dslr_{purpose}_{round(datetime.now().timestamp())}"
+
+
+def is_local_backend(pid: int) -> bool:
+    """
+    Returns whether the given server process ID belongs to a Postgres process
+    on this machine
+
+    The server reports process IDs from its own PID namespace, so when it runs
+    in a container, the same ID may belong to an unrelated process here. The
+    process has to be a postgres process owned by the owner of the server's
+    data directory.
+    """
+    # Unprivileged users don't get to see the data directory
+    result = exec_sql("SELECT setting FROM pg_settings WHERE name = 'data_directory'")
+
+    if not result:
+        return False
+
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            cmdline = f.read()
+
+        owner = os.stat(f"/proc/{pid}").st_uid
+        data_directory_owner = os.stat(result[0][0]).st_uid
+    except OSError:
+        return False
+
+    return b"postgres" in cmdline and owner == data_directory_owner
+
+
+def lower_backend_priority() -> bool:
+    """
+    Lowers the CPU and I/O priority of the server process behind our connection
+
+    Template copies run inside the backend process that issues the CREATE
+    DATABASE, so renicing it throttles the copy without touching the rest of
+    the server. This only works when the server runs on this machine and we're
+    allowed to renice its processes, so it's best effort. Returns whether the
+    CPU priority was lowered.
+    """
+    if settings.db.host not in LOCAL_HOSTS and not settings.db.host.startswith("/"):
+        return False
+
+    result = exec_sql("SELECT pg_backend_pid()")
+
+    if not result or not is_local_backend(result[0][0]):
+        return False
+
+    pid = str(result[0][0])
+
+    try:
+        exec_shell("renice", "-n", "19", "-p", pid)
+    except (OSError, RuntimeError):
+        return False
+
+    # The copy is throttled either way, lowering its I/O priority is a bonus
+    try:
+        exec_shell("ionice", "-c", "3", "-p", pid)
+    except (OSError, RuntimeError):
+        pass
+
+    return True
 
 
 def drop_database(dbname: str):
@@ -52,11 +312,451 @@ def drop_database(dbname: str):
     exec_sql(sql.SQL("DROP DATABASE {}").format(sql.Identifier(dbname)))
 
 
+def is_excluded_table(schema: str, table: str) -> bool:
+    """
+    Returns whether the given table matches any of the `exclude_tables` globs
+
+    Patterns containing a dot are matched against "schema.table", otherwise
+    they're matched against the table name alone.
+    """
+    for pattern in settings.exclude_tables:
+        target = f"{schema}.{table}" if "." in pattern else table
+
+        if fnmatchcase(target, pattern):
+            return True
+
+    return False
+
+
+def slim_database(dbname: str):
+    """
+    Drops the data of excluded tables in the given database, keeping their
+    schema, then optionally vacuums it so that it takes up less space on disk
+    """
+    if not settings.exclude_tables and not settings.vacuum_snapshot:
+        return
+
+    with db_session(dbname) as client:
+        tables = client.execute(
+            """
+            SELECT schemaname, tablename
+            FROM pg_tables
+            WHERE schemaname NOT IN ('pg_catalog', 'information_schema')
+            """,
+            None,
+        )
+
+        excluded = [
+            sql.Identifier(schema, table)
+            for schema, table in tables or []
+            if is_excluded_table(schema, table)
+        ]
+
+        if excluded:
+            client.execute(
+                sql.SQL("TRUNCATE {}").format(sql.SQL(", ").join(excluded)), None
+            )
+
+        if settings.vacuum_snapshot:
+            client.execute("VACUUM FULL", None)
+
+
+# How many of the most used relations to remember for prewarming
+HOT_RELATIONS_LIMIT = 100
+
+# Ranks relations by how many of their blocks have been accessed since the
+# statistics were last reset
+STATIO_HOT_RELATIONS_QUERY = """
+SELECT name
+FROM (
+    SELECT relid::regclass::text AS name, heap_blks_hit + heap_blks_read AS blocks
+    FROM pg_statio_user_tables
+    UNION ALL
+    SELECT indexrelid::regclass::text, idx_blks_hit + idx_blks_read
+    FROM pg_statio_user_indexes
+) AS relations
+WHERE blocks > 0
+ORDER BY blocks DESC
+LIMIT %s
+"""
+
+# Ranks relations by how many of their blocks are in shared buffers right now
+BUFFERCACHE_HOT_RELATIONS_QUERY = """
+SELECT pg_class.oid::regclass::text
+FROM pg_buffercache
+JOIN pg_class
+    ON pg_relation_filenode(pg_class.oid) = pg_buffercache.relfilenode
+JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
+WHERE pg_buffercache.reldatabase = (
+    SELECT oid FROM pg_database WHERE datname = current_database()
+)
+AND pg_namespace.nspname NOT IN ('pg_catalog', 'information_schema')
+AND pg_namespace.nspname NOT LIKE 'pg\\_%%'
+GROUP BY pg_class.oid
+ORDER BY count(*) DESC
+LIMIT %s
+"""
+
+
+def has_extension(client: PGClient, extension: str) -> bool:
+    """
+    Returns whether the given extension is installed in the client's database
+    """
+    result = client.execute(
+        "SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = %s)", [extension]
+    )
+
+    return bool(result and result[0][0])
+
+
+def get_hot_relations(dbname: str) -> List[str]:
+    """
+    Returns the most used tables and indexes of the given database, most used
+    first
+
+    The contents of shared buffers are the best indicator if pg_buffercache is
+    installed, otherwise the block access statistics are used.
+    """
+    # Don't bother connecting if nothing has been read from the database
+    result = exec_sql(
+        "SELECT blks_hit + blks_read FROM pg_stat_database WHERE datname = %s",
+        [dbname],
+    )
+
+    if not result or not result[0][0]:
+        return []
+
+    with db_session(dbname) as client:
+        if has_extension(client, "pg_buffercache"):
+            query = BUFFERCACHE_HOT_RELATIONS_QUERY
+        else:
+            query = STATIO_HOT_RELATIONS_QUERY
+
+        rows = client.execute(query, [HOT_RELATIONS_LIMIT])
+
+    return [name for (name,) in rows or []]
+
+
+def prewarm_relations(dbname: str, relations: List[str]):
+    """
+    Loads the given relations of the given database into shared buffers
+    """
+    with db_session(dbname) as client:
+        for relation in relations:
+            client.execute("SELECT pg_prewarm(%s::regclass)", [relation])
+
+
+def prewarm_database(relations: List[str], jobs: Optional[int] = None) -> List[str]:
+    """
+    Loads the given relations of the database into shared buffers in parallel,
+    most important first, so that the first queries don't hit a cold cache
+
+    Relations that no longer exist are skipped, and only as many are loaded as
+    fit in the `prewarm_budget` setting, which defaults to the size of shared
+    buffers. Nothing happens if the pg_prewarm extension isn't installed.
+    Returns the relations that were loaded.
+    """
+    with db_session(settings.db.name) as client:
+        if not has_extension(client, "pg_prewarm"):
+            return []
+
+        budget = client.execute(
+            "SELECT pg_size_bytes(coalesce(%s, current_setting('shared_buffers')))",
+            [settings.prewarm_budget],
+        )
+        sizes = client.execute(
+            """
+            SELECT name, pg_relation_size(to_regclass(name))
+            FROM unnest(%s::text[]) WITH ORDINALITY AS relations(name, n)
+            WHERE to_regclass(name) IS NOT NULL
+            ORDER BY n
+            """,
+            [relations],
+        )
+
+    remaining = budget[0][0] if budget else 0
+    selected = []
+
+    for name, size in sizes or []:
+        if size <= remaining:
+            selected.append(name)
+            remaining -= size
+
+    if not selected:
+        return []
+
+    # Spread the hottest relations across the workers
+    jobs = min(jobs or get_default_jobs(), len(selected))
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for _ in executor.map(
+            partial(prewarm_relations, settings.db.name),
+            [selected[i::jobs] for i in range(jobs)],
+        ):
+            pass
+
+    return selected
+
+
+################################################################################
+# Locking
+################################################################################
+
+# How long to sleep between attempts when waiting for a lock
+LOCK_POLL_INTERVAL = 0.5
+
+
+class LockNotAcquired(Exception):
+    pass
+
+
+def snapshot_lock_key(snapshot_name: str) -> str:
+    """
+    Returns the advisory lock key for the given snapshot name
+    """
+    return f"snapshot:{snapshot_name}"
+
+
+def database_lock_key(dbname: str) -> str:
+    """
+    Returns the advisory lock key for the given database
+    """
+    return f"database:{dbname}"
+
+
+def acquire_lock(
+    key: str, wait: Optional[bool] = None, deadline: Optional[float] = None
+):
+    """
+    Takes an advisory lock on the given key
+
+    If `wait` (which defaults to the `wait` setting) is off, this fails
+    immediately when another process holds the lock. Otherwise, it waits for
+    the lock to be released, until the given `time.monotonic()` deadline if set.
+    """
+    if wait is None:
+        wait = settings.wait
+
+    while not try_advisory_lock(key):
+        if not wait or (deadline is not None and time.monotonic() >= deadline):
+            raise LockNotAcquired(
+                f'"{key}" is locked by another dslr process. '
+                "Use --wait to wait for it to finish."
+            )
+
+        time.sleep(LOCK_POLL_INTERVAL)
+
+
+@contextmanager
+def lock(*keys: str, wait: Optional[bool] = None) -> Iterator[None]:
+    """
+    Holds advisory locks on the given keys for the duration of the block
+
+    Locks are always acquired in the same order so that concurrent dslr
+    processes can't deadlock each other. The `lock_timeout` setting bounds the
+    wait for all of the locks together, not for each one.
+    """
+    acquired = []
+    deadline = (
+        time.monotonic() + settings.lock_timeout
+        if settings.lock_timeout is not None
+        else None
+    )
+
+    try:
+        for key in sorted(set(keys)):
+            acquire_lock(key, wait=wait, deadline=deadline)
+            acquired.append(key)
+
+        yield
+    finally:
+        for key in reversed(acquired):
+            advisory_unlock(key)
+
+
+################################################################################
+# Fingerprints
+################################################################################
+
+# Hashes the identity and row version of every row in the catalogs that DDL
+# touches. Any schema change, as well as anything that swaps a relation's files
+# (TRUNCATE, VACUUM FULL, CLUSTER...), writes a new row version. Sequences are
+# included because nextval() doesn't show up in the tuple counters.
+FINGERPRINT_CATALOG_QUERY = """
+SELECT md5(string_agg(row_key, ',' ORDER BY row_key))
+FROM (
+    SELECT 'class:' || oid || ':' || xmin FROM pg_class
+    UNION ALL
+    SELECT 'attribute:' || attrelid || '.' || attnum || ':' || xmin
+    FROM pg_attribute
+    UNION ALL
+    SELECT 'constraint:' || oid || ':' || xmin FROM pg_constraint
+    UNION ALL
+    SELECT 'namespace:' || oid || ':' || xmin FROM pg_namespace
+    UNION ALL
+    SELECT 'proc:' || oid || ':' || xmin FROM pg_proc
+    UNION ALL
+    SELECT 'rewrite:' || oid || ':' || xmin FROM pg_rewrite
+    UNION ALL
+    SELECT 'trigger:' || oid || ':' || xmin FROM pg_trigger
+    UNION ALL
+    SELECT 'type:' || oid || ':' || xmin FROM pg_type
+    UNION ALL
+    SELECT 'sequence:' || schemaname || '.' || sequencename || ':'
+        || coalesce(last_value::text, '')
+    FROM pg_sequences
+) AS catalog(row_key)
+"""
+
+
+def get_fingerprint(dbname: str, *extra: Any) -> Optional[str]:
+    """
+    Returns a cheap fingerprint of the contents of the given database
+
+    The fingerprint combines the database's tuple counters from
+    pg_stat_database with a hash of its catalogs, along with any extra values
+    that affect what a snapshot of it would contain. Connections to the
+    database should be killed first so that all of their changes have been
+    reported to the statistics system.
+
+    Server processes only report their statistics synchronously as they exit
+    since Postgres 15. Before that, the counters lag behind by up to half a
+    second, so older servers don't get a fingerprint.
+
+    Returns None if the fingerprint can't be computed, in which case the
+    database should be treated as changed.
+    """
+    try:
+        counters = exec_sql(
+            """
+            SELECT datid, tup_inserted, tup_updated, tup_deleted, stats_reset
+            FROM pg_stat_database
+            WHERE datname = %s
+            AND current_setting('server_version_num')::int >= 150000
+            """,
+            [dbname],
+        )
+
+        if not counters:
+            return None
+
+        with db_session(dbname) as client:
+            catalog = client.execute(FINGERPRINT_CATALOG_QUERY, None)
+    except Exception as e:
+        if settings.debug:
+            console.log(f"Failed to fingerprint {dbname}: {e}")
+
+        return None
+
+    if not catalog or not catalog[0][0]:
+        return None
+
+    material = json.dumps([counters[0], catalog[0][0], *extra], default=str)
+
+    return hashlib.sha256(material.encode()).hexdigest()
+
+
+def compute_snapshot_fingerprint(tablespace: Optional[str] = None) -> Optional[str]:
+    """
+    Returns the fingerprint a snapshot of the database would have right now
+
+    The settings that change what ends up in a snapshot are part of the
+    fingerprint, so changing them invalidates existing snapshots. This needs to
+    run while the database is quiesced, so that the disconnected clients have
+    reported their statistics.
+    """
+    return get_fingerprint(
+        settings.db.name,
+        sorted(settings.exclude_tables),
+        settings.vacuum_snapshot,
+        tablespace or settings.snapshot_tablespace,
+    )
+
+
+def get_snapshot_fingerprint(tablespace: Optional[str] = None) -> Optional[str]:
+    """
+    Quiesces the database and returns the fingerprint a snapshot of it would
+    have right now
+    """
+    with quiesce(settings.db.name):
+        return compute_snapshot_fingerprint(tablespace)
+
+
+################################################################################
+# History
+################################################################################
+
+
+def get_server_version() -> Optional[str]:
+    """
+    Returns the version of the Postgres server
+    """
+    result = exec_sql("SHOW server_version")
+
+    return result[0][0] if result else None
+
+
+def get_database_size(dbname: str) -> Optional[int]:
+    """
+    Returns the size of the given database in bytes
+    """
+    result = exec_sql("SELECT pg_database_size(%s)", [dbname])
+
+    return result[0][0] if result else None
+
+
+@contextmanager
+def track(
+    operation: str, strategy: str, snapshot_name: Optional[str] = None
+) -> Iterator[Run]:
+    """
+    Times the block and records it in the local history
+
+    The block can fill in the number of bytes involved on the yielded run.
+    Failed runs are recorded too, but problems recording the history never fail
+    the operation itself.
+    """
+    run = Run(
+        operation=operation,
+        strategy=strategy,
+        database=settings.db.name,
+        started_at=datetime.now(),
+        snapshot_name=snapshot_name,
+    )
+    started_at = time.monotonic()
+
+    try:
+        yield run
+        run.succeeded = True
+    finally:
+        run.duration = time.monotonic() - started_at
+
+        # Bookkeeping should never mask the outcome of the operation itself
+        try:
+            run.server_version = get_server_version()
+            record_run(run)
+        except Exception as e:
+            if settings.debug:
+                console.log(f"Failed to record history: {e}")
+
+
 ################################################################################
 # Snapshot operations
 ################################################################################
 
-Snapshot = namedtuple("Snapshot", ["dbname", "name", "created_at", "size"])
+Snapshot = namedtuple(
+    "Snapshot",
+    [
+        "dbname",
+        "name",
+        "created_at",
+        "size",
+        "tablespace",
+        "fingerprint",
+        "hot_relations",
+    ],
+    defaults=[None, None],
+)
 
 
 def generate_snapshot_db_name(
@@ -85,25 +785,38 @@ def get_snapshots() -> List[Snapshot]:
     result = exec_sql(
         """
         SELECT
-            datname,
-            pg_size_pretty(pg_database_size(datname))
+            pg_database.datname,
+            pg_size_pretty(pg_database_size(pg_database.datname)),
+            pg_tablespace.spcname,
+            shobj_description(pg_database.oid, 'pg_database')
         FROM pg_database
-        WHERE datname LIKE 'dslr_%'
+        JOIN pg_tablespace ON pg_tablespace.oid = pg_database.dattablespace
+        WHERE pg_database.datname LIKE 'dslr_%'
         """
     )
 
     if result is None:
         raise RuntimeError("Did not get results from database.")
 
-    return [
-        Snapshot(
-            dbname=line,
-            name="_".join(part[2:]),
-            created_at=datetime.fromtimestamp(int(part[1])),
-            size=size,
+    snapshots = []
+
+    for dbname, size, tablespace, comment in result:
+        part = dbname.split("_")
+        metadata = parse_database_metadata(comment)
+
+        snapshots.append(
+            Snapshot(
+                dbname=dbname,
+                name="_".join(part[2:]),
+                created_at=datetime.fromtimestamp(int(part[1])),
+                size=size,
+                tablespace=tablespace,
+                fingerprint=metadata.get("fingerprint"),
+                hot_relations=metadata.get("hot_relations"),
+            )
         )
-        for line, part, size in [(row[0], row[0].split("_"), row[1]) for row in result]
-    ]
+
+    return snapshots
 
 
 class SnapshotNotFound(Exception):
@@ -126,21 +839,74 @@ def find_snapshot(snapshot_name: str) -> Snapshot:
         ) from e
 
 
-def create_snapshot(snapshot_name: str):
+def create_snapshot(snapshot_name: str, tablespace: Optional[str] = None):
     """
     Takes a snapshot of the database
 
     Snapshotting works by creating a new database using the local database as a
-    template.
+    template. The data of any excluded tables is then truncated in the copy.
+
+    The snapshot is placed on the given tablespace, falling back to the
+    `snapshot_tablespace` setting. It's tagged with the fingerprint of the
+    database so that unchanged databases don't need to be copied again, and
+    with its most used relations so that they can be prewarmed after restoring.
     """
-    kill_connections(settings.db.name)
-    create_database(
-        dbname=generate_snapshot_db_name(snapshot_name), template=settings.db.name
-    )
+    dbname = generate_snapshot_db_name(snapshot_name)
+    strategy = "template+truncate" if settings.exclude_tables else "template"
 
+    with track("snapshot", strategy, snapshot_name) as run:
+        hot_relations = get_hot_relations(settings.db.name)
 
-def delete_snapshot(snapshot: Snapshot):
-    """
+        # Fingerprint and copy while quiesced, so that the fingerprint describes
+        # exactly what was copied
+        with quiesce(settings.db.name):
+            fingerprint = compute_snapshot_fingerprint(tablespace)
+            create_database(
+                dbname=dbname,
+                template=settings.db.name,
+                tablespace=tablespace or settings.snapshot_tablespace,
+            )
+
+        try:
+            slim_database(dbname)
+        except Exception:
+            # Don't leave a snapshot behind that still has the excluded data
+            drop_database(dbname)
+            raise
+
+        metadata = {"fingerprint": fingerprint, "hot_relations": hot_relations}
+
+        if any(metadata.values()):
+            set_database_metadata(dbname, metadata)
+
+        run.bytes = get_database_size(dbname)
+
+
+def find_unchanged_snapshot(snapshot_name: str, fingerprint: str) -> Optional[Snapshot]:
+    """
+    Returns an existing snapshot that can stand in for a new snapshot with the
+    given name and fingerprint, if any
+
+    A snapshot with the given name is preferred. Otherwise, an automatic
+    snapshot can be renamed instead of copying the database again, since those
+    are disposable anyway. Other snapshots are never reused, as they might be
+    restored or deleted independently.
+    """
+    matches = [s for s in get_snapshots() if s.fingerprint == fingerprint]
+
+    for snapshot in matches:
+        if snapshot.name == snapshot_name:
+            return snapshot
+
+    for snapshot in matches:
+        if is_auto_snapshot(snapshot):
+            return snapshot
+
+    return None
+
+
+def delete_snapshot(snapshot: Snapshot):
+    """
     Deletes the given snapshot
     """
     drop_database(snapshot.dbname)
@@ -149,39 +915,1027 @@ def delete_snapshot(snapshot: Snapshot):
 def restore_snapshot(snapshot: Snapshot):
     """
     Restores the database from the given snapshot
+
+    The database is recreated in its original tablespace, even if the snapshot
+    lives on a different one.
     """
-    kill_connections(settings.db.name)
-    drop_database(settings.db.name)
-    create_database(dbname=settings.db.name, template=snapshot.dbname)
+    with track("restore", "template", snapshot.name) as run:
+        tablespace = get_database_tablespace(settings.db.name)
+
+        with quiesce(settings.db.name):
+            drop_database(settings.db.name)
+            create_database(
+                dbname=settings.db.name,
+                template=snapshot.dbname,
+                tablespace=tablespace,
+            )
+
+        run.bytes = get_database_size(settings.db.name)
 
 
 def rename_snapshot(snapshot: Snapshot, new_name: str):
     """
     Renames the given snapshot
     """
-    exec_sql(
-        sql.SQL("ALTER DATABASE {} RENAME TO {}").format(
-            sql.Identifier(snapshot.dbname),
-            sql.Identifier(generate_snapshot_db_name(new_name, snapshot.created_at)),
-        )
+    rename_database(
+        snapshot.dbname, generate_snapshot_db_name(new_name, snapshot.created_at)
     )
 
 
-def export_snapshot(snapshot: Snapshot) -> str:
+def export_snapshot(
+    snapshot: Snapshot,
+    export_path: Optional[str] = None,
+    sample: Optional[float] = None,
+    limits: Optional[Dict[str, int]] = None,
+) -> str:
     """
     Exports the given snapshot to a file
+
+    If a sample percentage or row limits are given, only a referentially
+    consistent subset of the rows is exported. See `export_sample`.
     """
-    export_path = f"{snapshot.name}_{snapshot.created_at:%Y%m%d-%H%M%S}.dump"
-    exec_shell("pg_dump", "-Fc", "-d", snapshot.dbname, "-f", export_path)
+    if not export_path:
+        export_path = f"{snapshot.name}_{snapshot.created_at:%Y%m%d-%H%M%S}.dump"
+
+    sampled = sample is not None or bool(limits)
+
+    with track(
+        "export", "pg_dump-sample" if sampled else "pg_dump", snapshot.name
+    ) as run:
+        if sampled:
+            export_sample(snapshot, export_path, sample, limits or {})
+        else:
+            exec_shell("pg_dump", "-Fc", "-d", snapshot.dbname, "-f", export_path)
+
+        if os.path.exists(export_path):
+            run.bytes = os.path.getsize(export_path)
 
     return export_path
 
 
-def import_snapshot(import_path: str, snapshot_name: str):
+################################################################################
+# Sampled exports
+################################################################################
+
+# The columns of every regular table that can be copied, i.e. excluding dropped
+# and generated columns
+SAMPLE_TABLES_QUERY = """
+SELECT pg_namespace.nspname, pg_class.relname,
+    array_agg(pg_attribute.attname::text ORDER BY pg_attribute.attnum)
+FROM pg_class
+JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
+JOIN pg_attribute ON pg_attribute.attrelid = pg_class.oid
+WHERE pg_class.relkind = 'r'
+AND pg_namespace.nspname NOT IN ('pg_catalog', 'information_schema')
+AND pg_namespace.nspname NOT LIKE 'pg\\_%'
+AND pg_attribute.attnum > 0
+AND NOT pg_attribute.attisdropped
+AND pg_attribute.attgenerated = ''
+GROUP BY pg_namespace.nspname, pg_class.relname
+ORDER BY pg_namespace.nspname, pg_class.relname
+"""
+
+# Every foreign key as (child schema, child table, child columns, parent schema,
+# parent table, parent columns), with the columns in key order
+SAMPLE_FOREIGN_KEYS_QUERY = """
+SELECT child_ns.nspname, child.relname,
+    ARRAY(
+        SELECT attname::text
+        FROM unnest(pg_constraint.conkey) WITH ORDINALITY AS k(attnum, n)
+        JOIN pg_attribute ON attrelid = pg_constraint.conrelid AND attnum = k.attnum
+        ORDER BY k.n
+    ),
+    parent_ns.nspname, parent.relname,
+    ARRAY(
+        SELECT attname::text
+        FROM unnest(pg_constraint.confkey) WITH ORDINALITY AS k(attnum, n)
+        JOIN pg_attribute ON attrelid = pg_constraint.confrelid AND attnum = k.attnum
+        ORDER BY k.n
+    )
+FROM pg_constraint
+JOIN pg_class child ON child.oid = pg_constraint.conrelid
+JOIN pg_namespace child_ns ON child_ns.oid = child.relnamespace
+JOIN pg_class parent ON parent.oid = pg_constraint.confrelid
+JOIN pg_namespace parent_ns ON parent_ns.oid = parent.relnamespace
+WHERE pg_constraint.contype = 'f'
+"""
+
+Table = Tuple[str, str]
+
+
+def get_row_limit(limits: Dict[str, int], schema: str, table: str) -> Optional[int]:
     """
-    Imports the given snapshot from a file
+    Returns the row limit for the given table, if any
+
+    Limits can be given for "schema.table" or just the table name.
     """
-    dbname = generate_snapshot_db_name(snapshot_name)
+    return limits.get(f"{schema}.{table}", limits.get(table))
+
+
+def sort_tables_by_dependencies(
+    tables: List[Table], foreign_keys: List[Tuple[Table, List[str], Table, List[str]]]
+) -> List[Table]:
+    """
+    Orders the tables so that every table comes after the tables it refers to
+    through foreign keys
+
+    Tables in reference cycles come last, in their original order.
+    """
+    parents: Dict[Table, set] = {table: set() for table in tables}
+
+    for child, _, parent, _ in foreign_keys:
+        if child != parent:
+            parents[child].add(parent)
+
+    ordered: List[Table] = []
+    remaining = list(tables)
+
+    while True:
+        ready = [table for table in remaining if parents[table] <= set(ordered)]
+
+        if not ready:
+            return ordered + remaining
+
+        ordered += ready
+        remaining = [table for table in remaining if table not in ready]
+
+
+def sample_rows(
+    client: PGClient,
+    tables: List[Table],
+    foreign_keys: List[Tuple[Table, List[str], Table, List[str]]],
+    sample: Optional[float],
+    limits: Dict[str, int],
+) -> Dict[Table, sql.Identifier]:
+    """
+    Picks the rows to export from each table and returns the temporary tables
+    holding their ctids
+
+    Tables are sampled from the ones that don't refer to other tables down.
+    Tables with a row limit get that many random rows, tables that don't refer
+    to any picked rows get the given percentage of their rows, and all others
+    get every row whose referenced rows have been picked. The rows that the
+    picked rows still refer to through self references and reference cycles
+    are then added until there are none missing, so the sample stays
+    referentially consistent. Only those can take a table past its limit.
+
+    The temporary tables are indexed on the ctid and analyzed, since Postgres
+    can't hash ctids before version 14 and would otherwise rescan them for
+    every row it checks.
+    """
+    keep = {table: sql.Identifier(f"dslr_keep_{i}") for i, table in enumerate(tables)}
+    foreign_keys = [fk for fk in foreign_keys if fk[0] in keep and fk[2] in keep]
+    picked: List[Table] = []
+
+    for schema, table in sort_tables_by_dependencies(tables, foreign_keys):
+        keep_table = keep[(schema, table)]
+        limit = get_row_limit(limits, schema, table)
+
+        # Only pick rows whose referenced rows have been picked, so that the
+        # limits of the referenced tables hold
+        conditions = [
+            sql.SQL(
+                """
+                ({} OR EXISTS (
+                    SELECT FROM {} AS parent_keep
+                    JOIN {} AS parent ON parent.ctid = parent_keep.row_id
+                    WHERE {}
+                ))
+                """
+            ).format(
+                sql.SQL(" OR ").join(
+                    sql.SQL("source.{} IS NULL").format(sql.Identifier(column))
+                    for column in child_columns
+                ),
+                keep[parent],
+                sql.Identifier(*parent),
+                sql.SQL(" AND ").join(
+                    sql.SQL("parent.{} = source.{}").format(
+                        sql.Identifier(parent_column), sql.Identifier(child_column)
+                    )
+                    for child_column, parent_column in zip(
+                        child_columns, parent_columns, strict=True
+                    )
+                ),
+            )
+            for child, child_columns, parent, parent_columns in foreign_keys
+            if child == (schema, table) and parent in picked
+        ]
+        query = sql.SQL(
+            "CREATE TEMP TABLE {} AS SELECT ctid AS row_id FROM {} AS source"
+        ).format(keep_table, sql.Identifier(schema, table))
+
+        if limit is None and sample is not None and not conditions:
+            query += sql.SQL(" TABLESAMPLE BERNOULLI ({})").format(sql.Literal(sample))
+
+        if conditions:
+            query += sql.SQL(" WHERE ") + sql.SQL(" AND ").join(conditions)
+
+        if limit is not None:
+            query += sql.SQL(" ORDER BY random() LIMIT {}").format(sql.Literal(limit))
+
+        client.execute(query, None)
+        client.execute(sql.SQL("CREATE INDEX ON {} (row_id)").format(keep_table), None)
+        client.execute(sql.SQL("ANALYZE {}").format(keep_table), None)
+        picked.append((schema, table))
+
+    changed = True
+
+    while changed:
+        changed = False
+
+        for child, child_columns, parent, parent_columns in foreign_keys:
+            join = sql.SQL(" AND ").join(
+                sql.SQL("child.{} = parent.{}").format(
+                    sql.Identifier(child_column), sql.Identifier(parent_column)
+                )
+                for child_column, parent_column in zip(
+                    child_columns, parent_columns, strict=True
+                )
+            )
+            result = client.execute(
+                sql.SQL(
+                    """
+                    WITH added AS (
+                        INSERT INTO {parent_keep}
+                        SELECT DISTINCT parent.ctid
+                        FROM {child_keep} AS child_keep
+                        JOIN {child} AS child ON child.ctid = child_keep.row_id
+                        JOIN {parent} AS parent ON {join}
+                        WHERE NOT EXISTS (
+                            SELECT FROM {parent_keep} AS parent_keep
+                            WHERE parent_keep.row_id = parent.ctid
+                        )
+                        RETURNING 1
+                    )
+                    SELECT count(*) FROM added
+                    """
+                ).format(
+                    parent_keep=keep[parent],
+                    parent=sql.Identifier(*parent),
+                    child=sql.Identifier(*child),
+                    join=join,
+                    child_keep=keep[child],
+                ),
+                None,
+            )
+
+            if result and result[0][0]:
+                changed = True
+
+                # Keep the planner's row estimates in line as the table grows
+                client.execute(sql.SQL("ANALYZE {}").format(keep[parent]), None)
+
+    return keep
+
+
+def copy_sample(
+    source: PGClient,
+    target: PGClient,
+    sample: Optional[float],
+    limits: Dict[str, int],
+):
+    """
+    Copies a referentially consistent sample of the rows of the source database
+    into the matching tables of the target database
+
+    The target database needs to have the same tables, but no foreign keys yet.
+    """
+    columns = {
+        (schema, table): names
+        for schema, table, names in source.execute(SAMPLE_TABLES_QUERY, None) or []
+    }
+    foreign_keys = [
+        ((child_schema, child), child_columns, (parent_schema, parent), parent_columns)
+        for (
+            child_schema,
+            child,
+            child_columns,
+            parent_schema,
+            parent,
+            parent_columns,
+        ) in source.execute(SAMPLE_FOREIGN_KEYS_QUERY, None) or []
+    ]
+    keep = sample_rows(source, list(columns), foreign_keys, sample, limits)
+
+    for table, keep_table in keep.items():
+        column_list = sql.SQL(", ").join(map(sql.Identifier, columns[table]))
+
+        # The rows are spooled through a temporary file since the two
+        # connections can't stream into each other directly
+        with tempfile.TemporaryFile() as f:
+            source.copy_to(
+                sql.SQL(
+                    "COPY (SELECT {} FROM {} AS source WHERE EXISTS ("
+                    "SELECT FROM {} AS keep WHERE keep.row_id = source.ctid"
+                    ")) TO STDOUT"
+                ).format(column_list, sql.Identifier(*table), keep_table),
+                f,
+            )
+            f.seek(0)
+            target.copy_from(
+                sql.SQL("COPY {} ({}) FROM STDIN").format(
+                    sql.Identifier(*table), column_list
+                ),
+                f,
+            )
+
+
+def export_sample(
+    snapshot: Snapshot,
+    export_path: str,
+    sample: Optional[float],
+    limits: Dict[str, int],
+):
+    """
+    Exports a referentially consistent sample of the given snapshot to a file
+
+    The snapshot's schema is restored into a temporary database, the sampled
+    rows are copied into it before the indexes and constraints are created, and
+    the result is dumped like a regular export, so it can be imported as usual.
+    """
+    dbname = generate_temp_db_name("sample")
+    fd, schema_path = tempfile.mkstemp(suffix=".dump")
+    os.close(fd)
+
     create_database(dbname=dbname)
 
-    exec_shell("pg_restore", "-d", dbname, "--no-acl", "--no-owner", import_path)
+    try:
+        # Excluding the data of all tables keeps the sequence values
+        exec_shell(
+            "pg_dump",
+            "-Fc",
+            "-d",
+            snapshot.dbname,
+            "--exclude-table-data=*.*",
+            "-f",
+            schema_path,
+        )
+        run_pg_restore(schema_path, dbname, "--section=pre-data")
+
+        with db_session(snapshot.dbname) as source, db_session(dbname) as target:
+            copy_sample(source, target, sample, limits)
+
+        run_pg_restore(schema_path, dbname, "--section=data")
+        run_pg_restore(schema_path, dbname, "--section=post-data")
+        exec_shell("pg_dump", "-Fc", "-d", dbname, "-f", export_path)
+    finally:
+        os.remove(schema_path)
+        drop_database(dbname)
+
+
+# Session settings that speed up bulk loading, at the expense of durability
+# guarantees that a freshly imported snapshot doesn't need
+BULK_LOAD_SETTINGS = {
+    "synchronous_commit": "off",
+}
+
+# Every parallel pg_restore job is a session of its own, so the memory and
+# parallel workers for building indexes are split between them
+MAINTENANCE_WORK_MEM_BUDGET_MB = 1024
+MAINTENANCE_WORK_MEM_RANGE_MB = (64, 512)
+MAX_PARALLEL_MAINTENANCE_WORKERS = 4
+
+
+def get_bulk_load_settings(sessions: int = 1) -> Dict[str, str]:
+    """
+    Returns the bulk load settings for each of the given number of concurrent
+    pg_restore sessions
+    """
+    low, high = MAINTENANCE_WORK_MEM_RANGE_MB
+    work_mem = min(high, max(low, MAINTENANCE_WORK_MEM_BUDGET_MB // sessions))
+
+    return {
+        **BULK_LOAD_SETTINGS,
+        "maintenance_work_mem": f"{work_mem}MB",
+        "max_parallel_maintenance_workers": str(
+            MAX_PARALLEL_MAINTENANCE_WORKERS // sessions
+        ),
+    }
+
+
+def get_default_jobs() -> int:
+    """
+    Returns the default number of parallel jobs for imports
+    """
+    return os.cpu_count() or 1
+
+
+def run_concurrently(func: Callable[[Any], Any], items: Iterable[Any], jobs: int):
+    """
+    Calls the function on each item, with at most `jobs` calls running at once
+
+    The first failure cancels the calls that haven't started yet and is raised
+    once the running ones have finished.
+    """
+    failed = threading.Event()
+
+    def call(item: Any):
+        # A worker may pick up the next item before the failure is noticed here
+        if failed.is_set():
+            return
+
+        try:
+            func(item)
+        except BaseException:
+            failed.set()
+            raise
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(call, item) for item in items]
+
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except BaseException:
+            executor.shutdown(cancel_futures=True)
+            raise
+
+
+def run_pg_restore(import_path: str, dbname: str, *args: str, sessions: int = 1):
+    """
+    Runs pg_restore against the given database with bulk load session settings
+
+    `sessions` is the number of pg_restore sessions running at once, counting
+    parallel jobs, which share the memory for building indexes.
+    """
+    options = " ".join(
+        f"-c {name}={value}" for name, value in get_bulk_load_settings(sessions).items()
+    )
+
+    # Keep any options the user has set themselves
+    if os.environ.get("PGOPTIONS"):
+        options = f"{os.environ['PGOPTIONS']} {options}"
+
+    exec_shell(
+        "pg_restore",
+        "-d",
+        dbname,
+        "--no-acl",
+        "--no-owner",
+        *args,
+        import_path,
+        extra_env={"PGOPTIONS": options},
+    )
+
+
+@contextmanager
+def timed(timings: Dict[str, float], phase: str) -> Iterator[None]:
+    """
+    Records how long the block took, in seconds, under the given phase
+    """
+    started_at = time.monotonic()
+
+    try:
+        yield
+    finally:
+        timings[phase] = time.monotonic() - started_at
+
+
+# Archive formats that pg_restore can restore with parallel jobs
+PARALLEL_DUMP_FORMATS = ("CUSTOM", "DIRECTORY")
+
+
+def get_dump_format(import_path: str) -> Optional[str]:
+    """
+    Returns the archive format of the dump (CUSTOM, DIRECTORY or TAR), as given
+    in the header of its table of contents
+    """
+    result = exec_shell("pg_restore", "-l", import_path)
+    match = re.search(r"^;\s+Format:\s+(\w+)", result.stdout, re.MULTILINE)
+
+    return match.group(1) if match else None
+
+
+def list_dump_entries(import_path: str, section: str) -> List[str]:
+    """
+    Returns the table of contents entries of the dump in the given section
+    """
+    result = exec_shell("pg_restore", "-l", f"--section={section}", import_path)
+
+    return [
+        line
+        for line in result.stdout.splitlines()
+        if line.strip() and not line.startswith(";")
+    ]
+
+
+def restore_dump_entries(
+    import_path: str, dbname: str, entries: List[str], sessions: int = 1
+):
+    """
+    Restores only the given table of contents entries of the dump, in a single
+    transaction, alongside `sessions - 1` other restores
+    """
+    fd, list_path = tempfile.mkstemp(suffix=".list")
+
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write("\n".join(entries) + "\n")
+
+        run_pg_restore(
+            import_path,
+            dbname,
+            "--single-transaction",
+            "-L",
+            list_path,
+            sessions=sessions,
+        )
+    finally:
+        os.remove(list_path)
+
+
+def get_table_data_entry_table(entry: str) -> Optional[Table]:
+    """
+    Returns the table that a TABLE DATA table of contents entry loads, or None
+    for other kinds of entries
+
+    Entries look like "10; 0 16386 TABLE DATA public users postgres", with the
+    owner last.
+    """
+    fields = entry.split(";", 1)[-1].split()
+
+    if fields[2:4] != ["TABLE", "DATA"] or len(fields) < 7:
+        return None
+
+    return fields[4], " ".join(fields[5:-1])
+
+
+def restore_sections(import_path: str, dbname: str, jobs: int) -> Dict[str, float]:
+    """
+    Restores the dump one section at a time
+
+    The schema is created first, then the data is loaded and the indexes and
+    constraints are built with parallel jobs. Returns the duration of each
+    section.
+    """
+    timings: Dict[str, float] = {}
+
+    # pg_restore refuses to run parallel jobs against tar archives
+    if jobs > 1 and get_dump_format(import_path) not in PARALLEL_DUMP_FORMATS:
+        jobs = 1
+
+    with timed(timings, "pre-data"):
+        run_pg_restore(import_path, dbname, "--section=pre-data")
+
+    for section in ("data", "post-data"):
+        with timed(timings, section):
+            run_pg_restore(
+                import_path,
+                dbname,
+                f"--section={section}",
+                f"--jobs={jobs}",
+                sessions=jobs,
+            )
+
+    return timings
+
+
+def analyze_database(dbname: str, jobs: int):
+    """
+    Gathers planner statistics for all tables of the given database
+
+    pg_restore doesn't restore statistics, so freshly imported databases would
+    otherwise get bad query plans until autovacuum gets around to them. The
+    statistics are gathered in stages, so rough statistics are available for
+    every table before the detailed ones are computed.
+    """
+    exec_shell("vacuumdb", "--analyze-in-stages", f"--jobs={jobs}", "-d", dbname)
+
+
+def restore_resumable(journal: ImportJournal, jobs: int) -> Dict[str, float]:
+    """
+    Restores the dump recorded in the journal step by step, skipping the steps
+    that have already been completed
+
+    The schema is restored first, then the data table by table using parallel
+    jobs, then the post-data entries (indexes, constraints, etc.) one at a time.
+    Each step runs in its own transaction, so a failure never leaves a step half
+    done. Returns the duration of each section.
+    """
+    import_path, dbname = journal.import_path, journal.dbname
+    timings: Dict[str, float] = {}
+    resuming = bool(journal.completed)
+
+    def restore_step(section: str, sessions: int, entry: str):
+        step = f"{section}:{entry.split(';')[0].strip()}"
+
+        if not journal.is_completed(step):
+            table = get_table_data_entry_table(entry)
+
+            # A crash between loading a table and recording it in the journal
+            # would otherwise load its rows twice
+            if resuming and table:
+                with db_session(dbname) as client:
+                    client.execute(
+                        sql.SQL("TRUNCATE {}").format(sql.Identifier(*table)), None
+                    )
+
+            restore_dump_entries(import_path, dbname, [entry], sessions)
+            journal.complete(step)
+
+    with timed(timings, "pre-data"):
+        if not journal.is_completed("pre-data"):
+            run_pg_restore(
+                import_path, dbname, "--single-transaction", "--section=pre-data"
+            )
+            journal.complete("pre-data")
+
+    with timed(timings, "data"):
+        run_concurrently(
+            partial(restore_step, "data", jobs),
+            list_dump_entries(import_path, "data"),
+            jobs,
+        )
+
+    # Post-data entries depend on each other (e.g. foreign keys on primary
+    # keys), so they're restored in table of contents order after all the data
+    with timed(timings, "post-data"):
+        for entry in list_dump_entries(import_path, "post-data"):
+            restore_step("post-data", 1, entry)
+
+    return timings
+
+
+def find_resumable_import(
+    import_path: str, snapshot_name: str
+) -> Optional[ImportJournal]:
+    """
+    Returns the journal of an unfinished import of the given file into the given
+    snapshot, if its database still exists
+    """
+    journal = ImportJournal.load(snapshot_name)
+
+    if journal is None or journal.import_path != os.path.abspath(import_path):
+        return None
+
+    if not database_exists(journal.dbname):
+        return None
+
+    return journal
+
+
+def import_snapshot(
+    import_path: str,
+    snapshot_name: str,
+    resumable: bool = False,
+    jobs: Optional[int] = None,
+    created_at: Optional[datetime] = None,
+    analyze: bool = True,
+) -> Dict[str, float]:
+    """
+    Imports the given snapshot from a file
+
+    Resumable imports record their progress in a journal. If a resumable import
+    of the same file fails, running it again continues where it stopped instead
+    of starting over. Until it's done, the data is loaded into a temporary
+    database that doesn't show up as a snapshot. Non-resumable imports clean up
+    after themselves instead.
+
+    Unless `analyze` is False, planner statistics are gathered once the data is
+    in, so that databases restored from the snapshot inherit them.
+
+    The snapshot is timestamped with `created_at` if given, or the current time.
+    Returns how long each section of the dump took to restore.
+    """
+    jobs = jobs or get_default_jobs()
+    strategy = "pg_restore-resumable" if resumable else "pg_restore"
+
+    with track("import", strategy, snapshot_name) as run:
+        if resumable:
+            journal = find_resumable_import(import_path, snapshot_name)
+
+            if journal is None:
+                journal = ImportJournal(
+                    snapshot_name=snapshot_name,
+                    import_path=os.path.abspath(import_path),
+                    dbname=generate_temp_db_name(f"import_{snapshot_name}"),
+                )
+                create_database(
+                    dbname=journal.dbname, tablespace=settings.snapshot_tablespace
+                )
+                journal.save()
+
+            timings = restore_resumable(journal, jobs)
+
+            if analyze and not journal.is_completed("analyze"):
+                with timed(timings, "analyze"):
+                    analyze_database(journal.dbname, jobs)
+
+                journal.complete("analyze")
+
+            dbname = generate_snapshot_db_name(snapshot_name, created_at)
+            rename_database(journal.dbname, dbname)
+            journal.discard()
+            run.bytes = get_database_size(dbname)
+            return timings
+
+        dbname = generate_snapshot_db_name(snapshot_name, created_at)
+        create_database(dbname=dbname, tablespace=settings.snapshot_tablespace)
+
+        try:
+            timings = restore_sections(import_path, dbname, jobs)
+
+            if analyze:
+                with timed(timings, "analyze"):
+                    analyze_database(dbname, jobs)
+        except Exception:
+            drop_database(dbname)
+            raise
+
+        run.bytes = get_database_size(dbname)
+        return timings
+
+
+def restore_from_file(
+    import_path: str, jobs: Optional[int] = None, analyze: bool = True
+) -> Dict[str, float]:
+    """
+    Restores the database directly from a dump file
+
+    The dump is loaded into a new database, which is then swapped in for the
+    working database. Unlike importing a snapshot and restoring it, this only
+    writes the data once. Unless `analyze` is False, planner statistics are
+    gathered before the swap. Returns how long each phase took.
+    """
+    jobs = jobs or get_default_jobs()
+
+    with track("restore", "pg_restore+swap") as run:
+        tablespace = get_database_tablespace(settings.db.name)
+        dbname = generate_temp_db_name("restore")
+        create_database(dbname=dbname, tablespace=tablespace)
+
+        try:
+            timings = restore_sections(import_path, dbname, jobs)
+
+            if analyze:
+                with timed(timings, "analyze"):
+                    analyze_database(dbname, jobs)
+        except Exception:
+            drop_database(dbname)
+            raise
+
+        with timed(timings, "swap"), quiesce(settings.db.name):
+            drop_database(settings.db.name)
+            rename_database(dbname, settings.db.name)
+
+        run.bytes = get_database_size(settings.db.name)
+        return timings
+
+
+################################################################################
+# Bundles
+################################################################################
+
+BUNDLE_MANIFEST = "manifest.json"
+
+BundleEntry = namedtuple("BundleEntry", ["name", "created_at", "filename"])
+
+
+def export_bundle(snapshots: List[Snapshot], jobs: Optional[int] = None) -> str:
+    """
+    Exports the given snapshots into a single archive
+
+    The snapshots are exported concurrently, with at most `jobs` exports
+    running at once. The archive contains the dumps along with a manifest of
+    their original names and creation times.
+    """
+    bundle_path = f"snapshots_{datetime.now():%Y%m%d-%H%M%S}.tar"
+
+    # Stage the dumps next to the bundle rather than in the system temporary
+    # directory, which may be small or in memory
+    with tempfile.TemporaryDirectory(
+        prefix=".dslr-", dir=os.path.dirname(os.path.abspath(bundle_path))
+    ) as tmp_dir:
+        entries = [
+            BundleEntry(
+                name=snapshot.name,
+                # Taken from the database name, so it doesn't depend on the
+                # local timezone
+                created_at=datetime.fromtimestamp(
+                    int(snapshot.dbname.split("_")[1]), tz=timezone.utc
+                ),
+                filename=f"{snapshot.dbname}.dump",
+            )
+            for snapshot in snapshots
+        ]
+
+        run_concurrently(
+            lambda item: export_snapshot(
+                item[0], os.path.join(tmp_dir, item[1].filename)
+            ),
+            zip(snapshots, entries, strict=True),
+            jobs or get_default_jobs(),
+        )
+
+        manifest_path = os.path.join(tmp_dir, BUNDLE_MANIFEST)
+        with open(manifest_path, "w") as f:
+            json.dump(
+                {
+                    "snapshots": [
+                        {
+                            "name": entry.name,
+                            "timestamp": round(entry.created_at.timestamp()),
+                            "filename": entry.filename,
+                        }
+                        for entry in entries
+                    ]
+                },
+                f,
+                indent=2,
+            )
+
+        # The dumps are already compressed, so the archive itself isn't
+        with tarfile.open(bundle_path, "w") as tar:
+            tar.add(manifest_path, arcname=BUNDLE_MANIFEST)
+
+            # Drop each dump once it's in the archive so that they don't take
+            # up twice the space
+            for entry in entries:
+                dump_path = os.path.join(tmp_dir, entry.filename)
+                tar.add(dump_path, arcname=entry.filename)
+                os.remove(dump_path)
+
+    return bundle_path
+
+
+def read_bundle_manifest(bundle_path: str) -> Optional[List[BundleEntry]]:
+    """
+    Returns the entries of the given bundle, or None if the file isn't a bundle
+    """
+    # Directory format dumps are never bundles
+    if not os.path.isfile(bundle_path) or not tarfile.is_tarfile(bundle_path):
+        return None
+
+    with tarfile.open(bundle_path) as tar:
+        try:
+            manifest_file = tar.extractfile(BUNDLE_MANIFEST)
+        except KeyError:
+            return None
+
+        if manifest_file is None:
+            return None
+
+        manifest = json.load(manifest_file)
+
+    return [
+        BundleEntry(
+            name=entry["name"],
+            created_at=datetime.fromtimestamp(entry["timestamp"], tz=timezone.utc),
+            filename=entry["filename"],
+        )
+        for entry in manifest["snapshots"]
+    ]
+
+
+def import_bundle(
+    bundle_path: str, jobs: Optional[int] = None, analyze: bool = True
+) -> List[str]:
+    """
+    Imports all of the snapshots in the given bundle
+
+    The snapshots are imported concurrently, with at most `jobs` imports
+    running at once, and keep their original names and creation times. Returns
+    the names of the imported snapshots.
+    """
+    entries = read_bundle_manifest(bundle_path)
+
+    if entries is None:
+        raise ValueError(f"{bundle_path} is not a snapshot bundle.")
+
+    jobs = jobs or get_default_jobs()
+
+    # Split the CPUs between the concurrent imports
+    jobs_per_import = max(1, get_default_jobs() // min(jobs, len(entries) or 1))
+
+    with tarfile.open(bundle_path) as tar:
+        # Only ever extract plain files into the staging directory
+        for entry in entries:
+            member = tar.getmember(entry.filename)
+
+            if not member.isfile() or os.path.basename(member.name) != member.name:
+                raise ValueError(f"Invalid file in bundle: {member.name}")
+
+    def import_entry(tmp_dir: str, entry: BundleEntry):
+        dump_path = os.path.join(tmp_dir, entry.filename)
+
+        # pg_restore needs a seekable file for parallel jobs, so each dump is
+        # extracted on its own just before it's imported. Every import reads
+        # the bundle through its own handle since tarfile isn't thread-safe.
+        with tarfile.open(bundle_path) as tar, open(dump_path, "wb") as f:
+            dump_file = tar.extractfile(entry.filename)
+
+            if dump_file is None:
+                raise ValueError(f"Invalid file in bundle: {entry.filename}")
+
+            shutil.copyfileobj(dump_file, f)
+
+        try:
+            import_snapshot(
+                dump_path,
+                entry.name,
+                jobs=jobs_per_import,
+                created_at=entry.created_at,
+                analyze=analyze,
+            )
+        finally:
+            os.remove(dump_path)
+
+    # Stage the dumps next to the bundle rather than in the system temporary
+    # directory, which may be small or in memory
+    with tempfile.TemporaryDirectory(
+        prefix=".dslr-", dir=os.path.dirname(os.path.abspath(bundle_path))
+    ) as tmp_dir:
+        run_concurrently(partial(import_entry, tmp_dir), entries, jobs)
+
+    return [entry.name for entry in entries]
+
+
+################################################################################
+# Automatic snapshots
+################################################################################
+
+AUTO_SNAPSHOT_PREFIX = "auto-"
+
+# Only names in exactly the generated format are automatic snapshots, so that a
+# snapshot the user named e.g. "auto-before-migration" is never pruned
+AUTO_SNAPSHOT_NAME_PATTERN = re.compile(
+    re.escape(AUTO_SNAPSHOT_PREFIX) + r"\d{8}-\d{6}"
+)
+
+
+def auto_lock_key() -> str:
+    """
+    Returns the advisory lock key held while taking an automatic snapshot
+    """
+    return f"auto:{settings.db.name}"
+
+
+def generate_auto_snapshot_name(created_at: Optional[datetime] = None) -> str:
+    """
+    Generates a name for an automatic snapshot
+    """
+    if not created_at:
+        created_at = datetime.now()
+
+    return f"{AUTO_SNAPSHOT_PREFIX}{created_at:%Y%m%d-%H%M%S}"
+
+
+def is_auto_snapshot(snapshot: Snapshot) -> bool:
+    """
+    Returns whether the given snapshot was taken by `dslr auto`
+    """
+    return AUTO_SNAPSHOT_NAME_PATTERN.fullmatch(snapshot.name) is not None
+
+
+def get_auto_snapshots() -> List[Snapshot]:
+    """
+    Returns the automatic snapshots, newest first
+    """
+    return sorted(
+        (snapshot for snapshot in get_snapshots() if is_auto_snapshot(snapshot)),
+        key=lambda s: s.created_at,
+        reverse=True,
+    )
+
+
+def prune_auto_snapshots(keep: int) -> List[Snapshot]:
+    """
+    Deletes all but the `keep` most recent automatic snapshots
+
+    Snapshots that another dslr process is using (e.g. restoring from) are left
+    alone until the next run. Returns the deleted snapshots.
+    """
+    pruned = []
+
+    for snapshot in get_auto_snapshots()[keep:]:
+        try:
+            with lock(snapshot_lock_key(snapshot.name), wait=False):
+                delete_snapshot(snapshot)
+        except LockNotAcquired:
+            continue
+
+        pruned.append(snapshot)
+
+    return pruned
+
+
+def take_auto_snapshot(keep: int) -> Optional[str]:
+    """
+    Takes a timestamped automatic snapshot, then prunes old ones
+
+    Returns the name of the new snapshot, or None if the database hasn't
+    changed since the latest automatic snapshot.
+    """
+    auto_snapshots = get_auto_snapshots()
+
+    if auto_snapshots and auto_snapshots[0].fingerprint:
+        if get_snapshot_fingerprint() == auto_snapshots[0].fingerprint:
+            return None
+
+    snapshot_name = generate_auto_snapshot_name()
+
+    create_snapshot(snapshot_name)
+    prune_auto_snapshots(keep)
+
+    return snapshot_name
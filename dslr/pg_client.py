@@ -1,4 +1,5 @@
-from typing import Any, List, Optional, Tuple
+import threading
+from typing import IO, Any, List, Optional, Tuple
 
 try:
     import psycopg as psycopg
@@ -10,6 +11,14 @@ from dslr.console import console
 
 from .config import settings
 
+# All of DSLR's advisory locks are taken in this namespace (the first key of the
+# two-key form of the advisory lock functions) so that they don't collide with
+# any advisory locks the application itself uses. It spells "DSLR".
+ADVISORY_LOCK_NAMESPACE = 0x44534C52
+
+# How much data to send to the server at a time during COPY FROM STDIN
+COPY_CHUNK_SIZE = 1024 * 1024
+
 
 class PGClient:
     """
@@ -33,6 +42,10 @@ class PGClient:
         self._set_autocommit()
         self.cur = self.conn.cursor()
 
+        # Bulk operations share the connection between threads, and executing
+        # and fetching on the shared cursor has to happen atomically
+        self.lock = threading.Lock()
+
     def _set_autocommit(self):
         if hasattr(self.conn, "set_autocommit"):
             self.conn.set_autocommit(True)  # type: ignore
@@ -46,11 +59,69 @@ class PGClient:
             console.log(f"SQL: {sql}")
             console.log(f"DATA: {data}")
 
-        self.cur.execute(sql, data)
+        with self.lock:
+            self.cur.execute(sql, data)
 
-        try:
-            result = self.cur.fetchall()
-        except psycopg.ProgrammingError:
-            result = None
+            try:
+                result = self.cur.fetchall()
+            except psycopg.ProgrammingError:
+                result = None
 
         return result
+
+    def copy_to(self, sql, f: IO[bytes]):
+        """
+        Runs a COPY ... TO STDOUT statement, writing its output to the given
+        binary file
+        """
+        if settings.debug:
+            console.log(f"SQL: {sql}")
+
+        with self.lock:
+            if hasattr(self.cur, "copy"):
+                with self.cur.copy(sql) as copy:  # type: ignore
+                    for data in copy:
+                        f.write(data)
+            else:
+                self.cur.copy_expert(sql, f)  # type: ignore
+
+    def copy_from(self, sql, f: IO[bytes]):
+        """
+        Runs a COPY ... FROM STDIN statement, reading its input from the given
+        binary file
+        """
+        if settings.debug:
+            console.log(f"SQL: {sql}")
+
+        with self.lock:
+            if hasattr(self.cur, "copy"):
+                with self.cur.copy(sql) as copy:  # type: ignore
+                    while data := f.read(COPY_CHUNK_SIZE):
+                        copy.write(data)
+            else:
+                self.cur.copy_expert(sql, f, size=COPY_CHUNK_SIZE)  # type: ignore
+
+    def try_advisory_lock(self, key: str) -> bool:
+        """
+        Tries to take a session-level advisory lock on the given key without
+        waiting. Returns whether the lock was acquired.
+        """
+        result = self.execute(
+            "SELECT pg_try_advisory_lock(%s, hashtext(%s))",
+            [ADVISORY_LOCK_NAMESPACE, key],
+        )
+
+        return bool(result and result[0][0])
+
+    def advisory_unlock(self, key: str):
+        """
+        Releases an advisory lock taken with `try_advisory_lock`
+        """
+        self.execute(
+            "SELECT pg_advisory_unlock(%s, hashtext(%s))",
+            [ADVISORY_LOCK_NAMESPACE, key],
+        )
+
+    def close(self):
+        self.cur.close()
+        self.conn.close()
@@ -1,7 +1,9 @@
 import os
 import subprocess
+import threading
 from collections import namedtuple
-from typing import Any, List, Optional, Tuple, Union
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
 
 try:
     from psycopg import sql
@@ -16,9 +18,9 @@ from .console import console
 Result = namedtuple("Result", ["stdout", "stderr"])
 
 
-def exec_shell(*cmd: str) -> Result:
+def exec_shell(*cmd: str, extra_env: Optional[Dict[str, str]] = None) -> Result:
     """
-    Executes a command.
+    Executes a command, optionally with additional environment variables.
     """
 
     # Set PG environment variables based on the settings
@@ -27,6 +29,7 @@ def exec_shell(*cmd: str) -> Result:
     env["PGPORT"] = str(settings.db.port) or env.get("PGPORT", "")
     env["PGUSER"] = settings.db.username or env.get("PGUSER", "")
     env["PGPASSWORD"] = settings.db.password or env.get("PGPASSWORD", "")
+    env.update(extra_env or {})
 
     if settings.debug:
         console.log(f"COMMAND: {cmd}")
@@ -54,6 +57,49 @@ def exec_shell(*cmd: str) -> Result:
 
 # Singleton instance of PGClient
 pg_client: Optional[PGClient] = None
+pg_client_lock = threading.Lock()
+
+
+def get_pg_client() -> PGClient:
+    """
+    Returns the shared PGClient, connecting to the server if needed.
+    """
+    global pg_client
+
+    with pg_client_lock:
+        if not pg_client:
+            # We always want to connect to the `postgres` and not the target
+            # database because none of our operations need to query the target
+            # database.
+            pg_client = PGClient(
+                host=settings.db.host,
+                port=settings.db.port,
+                user=settings.db.username,
+                password=settings.db.password,
+                dbname="postgres",
+            )
+
+        return pg_client
+
+
+def reset_pg_client():
+    """
+    Closes the shared PGClient, so that the next query reconnects.
+
+    Long-running commands use this to recover from a lost connection, e.g. after
+    the server has restarted.
+    """
+    global pg_client
+
+    with pg_client_lock:
+        if pg_client:
+            try:
+                pg_client.close()
+            except Exception:
+                # The connection is likely gone already
+                pass
+
+            pg_client = None
 
 
 def exec_sql(
@@ -62,18 +108,78 @@ def exec_sql(
     """
     Executes a SQL query.
     """
-    global pg_client
+    return get_pg_client().execute(sql, data)
 
-    if not pg_client:
-        # We always want to connect to the `postgres` and not the target
-        # database because none of our operations need to query the target
-        # database.
-        pg_client = PGClient(
-            host=settings.db.host,
-            port=settings.db.port,
-            user=settings.db.username,
-            password=settings.db.password,
-            dbname="postgres",
-        )
 
-    return pg_client.execute(sql, data)
+def try_advisory_lock(key: str) -> bool:
+    """
+    Tries to take an advisory lock on the given key without waiting.
+
+    The lock is held by the shared connection, so it's released automatically
+    if the process exits.
+    """
+    return get_pg_client().try_advisory_lock(key)
+
+
+def advisory_unlock(key: str):
+    """
+    Releases an advisory lock taken with `try_advisory_lock`.
+    """
+    get_pg_client().advisory_unlock(key)
+
+
+@contextmanager
+def db_session(dbname: str) -> Iterator[PGClient]:
+    """
+    Opens a short-lived connection to the given database.
+
+    Unlike `exec_sql`, which always talks to the `postgres` database, this is
+    for the few operations that need to run queries inside a specific database.
+    The connection is closed on exit so that it doesn't prevent the database
+    from being used as a template afterwards.
+    """
+    client = PGClient(
+        host=settings.db.host,
+        port=settings.db.port,
+        user=settings.db.username,
+        password=settings.db.password,
+        dbname=dbname,
+    )
+
+    try:
+        yield client
+    finally:
+        client.close()
+
+
+def connect_pgbouncer() -> PGClient:
+    """
+    Connects to the PgBouncer admin console configured with the
+    `pgbouncer_admin_url` setting.
+
+    The admin console only understands the simple query protocol, which both
+    psycopg versions use as long as no query parameters are passed.
+    """
+    if not settings.pgbouncer:
+        raise ValueError("No PgBouncer admin URL configured.")
+
+    return PGClient(
+        host=settings.pgbouncer.host,
+        port=settings.pgbouncer.port,
+        user=settings.pgbouncer.username,
+        password=settings.pgbouncer.password,
+        dbname=settings.pgbouncer.name or "pgbouncer",
+    )
+
+
+@contextmanager
+def pgbouncer_session() -> Iterator[PGClient]:
+    """
+    Opens a short-lived connection to the PgBouncer admin console.
+    """
+    client = connect_pgbouncer()
+
+    try:
+        yield client
+    finally:
+        client.close()
@@ -1,4 +1,8 @@
+import json
 import os
+import tempfile
+import threading
+import time
 from datetime import datetime
 from typing import Any, List, Tuple
 from unittest import TestCase, mock
@@ -6,13 +10,59 @@ from unittest import TestCase, mock
 from click.testing import CliRunner
 
 from dslr import cli, operations, runner
+from dslr.journal import ImportJournal
 
 
 def stub_exec_shell(*args, **kwargs) -> runner.Result:
     return runner.Result(stdout="", stderr="")
 
 
-def stub_exec_sql(*args, **kwargs) -> List[Tuple[Any, ...]]:
+DUMP_ENTRIES = {
+    "pre-data": "",
+    "data": "10; 0 16386 TABLE DATA public users postgres\n"
+    "11; 0 16390 TABLE DATA public orders postgres\n",
+    "post-data": "; Selected TOC Entries:\n"
+    "12; 2606 16394 CONSTRAINT public users users_pkey postgres\n",
+}
+
+
+class RecordingExecShell:
+    """
+    Stands in for exec_shell, recording pg_restore calls along with the table of
+    contents entries passed to them
+    """
+
+    def __init__(self):
+        self.restored = []
+
+    def __call__(self, *cmd, **kwargs) -> runner.Result:
+        if "-l" in cmd:
+            section = next(arg for arg in cmd if arg.startswith("--section="))
+            return runner.Result(stdout=DUMP_ENTRIES[section[10:]], stderr="")
+
+        if "-L" in cmd:
+            with open(cmd[cmd.index("-L") + 1]) as f:
+                self.restored.append(f.read().strip())
+        elif cmd[0] == "pg_restore":
+            self.restored.append(
+                next(arg for arg in cmd if arg.startswith("--section="))
+            )
+
+        return runner.Result(stdout="", stderr="")
+
+
+def stub_pg_dump(*cmd, **kwargs) -> runner.Result:
+    if cmd[0] == "pg_dump":
+        with open(cmd[cmd.index("-f") + 1], "wb") as f:
+            f.write(b"PGDMP")
+
+    return runner.Result(stdout="", stderr="")
+
+
+def stub_exec_sql(query, *args, **kwargs) -> List[Tuple[Any, ...]]:
+    if "LIKE 'dslr_%'" not in str(query):
+        return []
+
     fake_snapshot_1 = operations.generate_snapshot_db_name(
         "existing-snapshot-1",
         created_at=datetime(2020, 1, 1, 0, 0, 0, 0),
@@ -21,13 +71,26 @@ def stub_exec_sql(*args, **kwargs) -> List[Tuple[Any, ...]]:
         "existing-snapshot-2",
         created_at=datetime(2020, 1, 2, 0, 0, 0, 0),
     )
-    return [(fake_snapshot_1, "100 kB"), (fake_snapshot_2, "100 kB")]
+    return [
+        (fake_snapshot_1, "100 kB", "pg_default", '{"fingerprint": "fp-1"}'),
+        (fake_snapshot_2, "100 kB", "fast_disk", None),
+    ]
 
 
 @mock.patch.dict(os.environ, {"DATABASE_URL": "postgres://user:pw@test:5432/my_db"})
 @mock.patch("dslr.operations.exec_shell", new=stub_exec_shell)
 @mock.patch("dslr.operations.exec_sql", new=stub_exec_sql)
+@mock.patch("dslr.operations.try_advisory_lock", new=mock.Mock(return_value=True))
+@mock.patch("dslr.operations.advisory_unlock", new=mock.Mock())
 class CliTest(TestCase):
+    def setUp(self):
+        state_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(state_dir.cleanup)
+
+        patcher = mock.patch.dict(os.environ, {"XDG_STATE_HOME": state_dir.name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     def test_executes(self):
         runner = CliRunner()
         result = runner.invoke(cli.cli, ["--help"])
@@ -68,6 +131,389 @@ class CliTest(TestCase):
         )
         self.assertIn("Updated snapshot existing-snapshot-1", result.output)
 
+    @mock.patch("dslr.operations.db_session")
+    def test_snapshot_exclude_tables(self, mock_db_session):
+        client = mock_db_session.return_value.__enter__.return_value
+        client.execute.return_value = [
+            ("public", "users"),
+            ("public", "event_log"),
+            ("audit", "changes"),
+        ]
+
+        with mock.patch(
+            "builtins.open",
+            mock.mock_open(
+                read_data=b"exclude_tables = ['audit.*', 'event_*']\n"
+                b"vacuum_snapshot = true"
+            ),
+        ):
+            runner = CliRunner()
+            result = runner.invoke(cli.cli, ["snapshot", "my-snapshot"])
+
+        self.assertEqual(result.exit_code, 0)
+        client.execute.assert_any_call(
+            operations.sql.SQL("TRUNCATE {}").format(
+                operations.sql.SQL(", ").join(
+                    [
+                        operations.sql.Identifier("public", "event_log"),
+                        operations.sql.Identifier("audit", "changes"),
+                    ]
+                )
+            ),
+            None,
+        )
+        client.execute.assert_any_call("VACUUM FULL", None)
+
+    @mock.patch("dslr.operations.create_database")
+    def test_snapshot_tablespace(self, mock_create_database):
+        runner = CliRunner()
+        result = runner.invoke(
+            cli.cli, ["snapshot", "my-snapshot", "--tablespace", "fast_disk"]
+        )
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(
+            mock_create_database.call_args.kwargs["tablespace"], "fast_disk"
+        )
+
+    @mock.patch("dslr.operations.create_database")
+    @mock.patch("dslr.cli.get_snapshot_fingerprint", return_value="fp-1")
+    def test_snapshot_unchanged(self, mock_fingerprint, mock_create_database):
+        # stub_exec sets up "existing-snapshot-1" with the fingerprint "fp-1"
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ["snapshot", "existing-snapshot-1"])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn(
+            "Snapshot existing-snapshot-1 is already up to date", result.output
+        )
+        mock_create_database.assert_not_called()
+
+    @mock.patch("dslr.operations.create_database")
+    @mock.patch("dslr.cli.get_snapshot_fingerprint", return_value="fp-1")
+    def test_snapshot_unchanged_force(self, mock_fingerprint, mock_create_database):
+        runner = CliRunner()
+        result = runner.invoke(
+            cli.cli, ["snapshot", "existing-snapshot-1", "-y", "--force"]
+        )
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Updated snapshot existing-snapshot-1", result.output)
+        mock_fingerprint.assert_not_called()
+        mock_create_database.assert_called_once()
+
+    @mock.patch("dslr.operations.rename_database")
+    @mock.patch("dslr.operations.create_database")
+    @mock.patch("dslr.operations.get_snapshots")
+    @mock.patch("dslr.cli.get_snapshot_fingerprint", return_value="fp-1")
+    def test_snapshot_reuses_unchanged_auto_snapshot(
+        self,
+        mock_fingerprint,
+        mock_get_snapshots,
+        mock_create_database,
+        mock_rename_database,
+    ):
+        mock_get_snapshots.return_value = [
+            operations.Snapshot(
+                dbname="dslr_1577836800000_auto-20200101-000000",
+                name="auto-20200101-000000",
+                created_at=datetime(2020, 1, 1),
+                size="100 kB",
+                tablespace="pg_default",
+                fingerprint="fp-1",
+            )
+        ]
+
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ["snapshot", "my-snapshot"])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn(
+            "Saved snapshot auto-20200101-000000 as my-snapshot", result.output
+        )
+        mock_create_database.assert_not_called()
+        mock_rename_database.assert_called_once()
+
+    @mock.patch("dslr.operations.rename_database")
+    @mock.patch("dslr.operations.create_database")
+    @mock.patch("dslr.operations.get_snapshots")
+    @mock.patch("dslr.cli.get_snapshot_fingerprint", return_value="fp-1")
+    def test_snapshot_keeps_manually_named_auto_snapshot(
+        self,
+        mock_fingerprint,
+        mock_get_snapshots,
+        mock_create_database,
+        mock_rename_database,
+    ):
+        mock_get_snapshots.return_value = [
+            operations.Snapshot(
+                dbname="dslr_1577836800_auto-setup",
+                name="auto-setup",
+                created_at=datetime(2020, 1, 1),
+                size="100 kB",
+                tablespace="pg_default",
+                fingerprint="fp-1",
+            )
+        ]
+
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ["snapshot", "my-snapshot"])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Created new snapshot my-snapshot", result.output)
+        mock_rename_database.assert_not_called()
+        mock_create_database.assert_called_once()
+
+    @mock.patch("dslr.operations.get_hot_relations", return_value=None)
+    @mock.patch("dslr.operations.get_fingerprint", return_value="fp-2")
+    @mock.patch("dslr.operations.kill_connections")
+    def test_snapshot_quiesces_once_per_step(
+        self, mock_kill_connections, mock_get_fingerprint, mock_get_hot_relations
+    ):
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ["snapshot", "my-snapshot"])
+
+        self.assertEqual(result.exit_code, 0)
+        # Once to check for changes, once to fingerprint and copy
+        self.assertEqual(mock_kill_connections.call_count, 2)
+        self.assertEqual(mock_get_fingerprint.call_count, 2)
+
+        mock_kill_connections.reset_mock()
+        result = runner.invoke(cli.cli, ["snapshot", "my-snapshot", "--force"])
+
+        self.assertEqual(result.exit_code, 0)
+        mock_kill_connections.assert_called_once_with("my_db")
+
+    @mock.patch("dslr.operations.time.sleep")
+    def test_snapshot_waits_for_connections_to_exit(self, mock_sleep):
+        terminated = []
+
+        def exec_sql(query, *args, **kwargs):
+            if "pg_terminate_backend" in str(query):
+                # The terminated backend takes a moment to exit
+                terminated.append(True)
+                return [(True,)] if len(terminated) < 3 else []
+
+            return stub_exec_sql(query, *args, **kwargs)
+
+        with mock.patch("dslr.operations.exec_sql", new=exec_sql):
+            operations.kill_connections("my_db")
+
+        self.assertEqual(len(terminated), 3)
+        self.assertEqual(mock_sleep.call_count, 2)
+
+    def test_snapshot_locked(self):
+        with mock.patch("dslr.operations.try_advisory_lock", return_value=False):
+            runner = CliRunner()
+            result = runner.invoke(cli.cli, ["snapshot", "my-snapshot"])
+
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("is locked by another dslr process", result.output)
+
+    @mock.patch("dslr.operations.time.sleep")
+    def test_snapshot_wait_for_lock(self, mock_sleep):
+        with (
+            mock.patch(
+                "dslr.operations.try_advisory_lock", side_effect=[False, True, True]
+            ),
+            mock.patch("dslr.operations.advisory_unlock") as mock_advisory_unlock,
+        ):
+            runner = CliRunner()
+            result = runner.invoke(cli.cli, ["--wait", "snapshot", "my-snapshot"])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Created new snapshot my-snapshot", result.output)
+        mock_sleep.assert_called_once()
+        self.assertEqual(
+            mock_advisory_unlock.call_args_list,
+            [mock.call("snapshot:my-snapshot"), mock.call("database:my_db")],
+        )
+
+    def test_snapshot_lock_timeout_covers_all_locks(self):
+        clock = [0.0]
+
+        def sleep(seconds):
+            clock[0] += seconds
+
+        def try_advisory_lock(key):
+            # The database lock frees up after 8 seconds, the snapshot lock never
+            return key == "database:my_db" and clock[0] >= 8
+
+        with (
+            mock.patch("dslr.operations.time.monotonic", side_effect=lambda: clock[0]),
+            mock.patch("dslr.operations.time.sleep", side_effect=sleep),
+            mock.patch(
+                "dslr.operations.try_advisory_lock", side_effect=try_advisory_lock
+            ),
+        ):
+            runner = CliRunner()
+            result = runner.invoke(
+                cli.cli, ["--timeout", "10", "snapshot", "my-snapshot"]
+            )
+
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('"snapshot:my-snapshot" is locked', result.output)
+        # The second lock only gets what's left of the timeout
+        self.assertLess(clock[0], 11)
+
+    def test_auto_once(self):
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ["auto", "--once"])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Created new snapshot auto-", result.output)
+
+    @mock.patch("dslr.cli.time.sleep", side_effect=[None, KeyboardInterrupt])
+    @mock.patch("dslr.cli.reset_pg_client")
+    @mock.patch("dslr.cli.lower_backend_priority", return_value=True)
+    @mock.patch(
+        "dslr.cli.take_auto_snapshot",
+        side_effect=[RuntimeError("connection already closed"), "auto-x"],
+    )
+    def test_auto_reconnects_after_failure(
+        self,
+        mock_take_auto_snapshot,
+        mock_lower_backend_priority,
+        mock_reset_pg_client,
+        mock_sleep,
+    ):
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ["auto"])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Failed to create snapshot", result.output)
+        self.assertIn("Created new snapshot auto-x", result.output)
+        mock_reset_pg_client.assert_called_once()
+        # The new backend gets its priority lowered too
+        self.assertEqual(mock_lower_backend_priority.call_count, 2)
+
+    @mock.patch("dslr.cli.time.sleep", side_effect=KeyboardInterrupt)
+    @mock.patch("dslr.operations.delete_snapshot")
+    @mock.patch("dslr.operations.get_snapshots")
+    def test_auto_prunes_old_snapshots(
+        self, mock_get_snapshots, mock_delete_snapshot, mock_sleep
+    ):
+        mock_get_snapshots.return_value = [
+            operations.Snapshot(
+                dbname=f"dslr_{day}_auto-202001{day:02}-000000",
+                name=f"auto-202001{day:02}-000000",
+                created_at=datetime(2020, 1, day),
+                size="100 kB",
+                tablespace="pg_default",
+            )
+            for day in range(1, 5)
+        ]
+
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ["auto", "--every", "1h", "--keep", "2"])
+
+        self.assertEqual(result.exit_code, 0)
+        mock_sleep.assert_called_once()
+        self.assertEqual(
+            [call.args[0].name for call in mock_delete_snapshot.call_args_list],
+            ["auto-20200102-000000", "auto-20200101-000000"],
+        )
+
+    @mock.patch("dslr.operations.delete_snapshot")
+    @mock.patch("dslr.operations.get_snapshots")
+    def test_auto_keeps_manually_named_snapshots(
+        self, mock_get_snapshots, mock_delete_snapshot
+    ):
+        mock_get_snapshots.return_value = [
+            operations.Snapshot(
+                dbname=f"dslr_{day}_{name}",
+                name=name,
+                created_at=datetime(2020, 1, day),
+                size="100 kB",
+                tablespace="pg_default",
+            )
+            for day, name in [
+                (1, "auto-before-big-migration"),
+                (2, "auto-20200102-000000"),
+                (3, "auto-20200103-000000"),
+            ]
+        ]
+
+        operations.prune_auto_snapshots(1)
+
+        self.assertEqual(
+            [call.args[0].name for call in mock_delete_snapshot.call_args_list],
+            ["auto-20200102-000000"],
+        )
+
+    @mock.patch("dslr.operations.create_database")
+    @mock.patch("dslr.operations.get_snapshot_fingerprint", return_value="fp-1")
+    @mock.patch("dslr.operations.get_snapshots")
+    def test_auto_skips_unchanged(
+        self, mock_get_snapshots, mock_fingerprint, mock_create_database
+    ):
+        mock_get_snapshots.return_value = [
+            operations.Snapshot(
+                dbname="dslr_1577836800000_auto-20200101-000000",
+                name="auto-20200101-000000",
+                created_at=datetime(2020, 1, 1),
+                size="100 kB",
+                tablespace="pg_default",
+                fingerprint="fp-1",
+            )
+        ]
+
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ["auto", "--once"])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Skipped snapshot, nothing has changed", result.output)
+        mock_create_database.assert_not_called()
+
+    @mock.patch("dslr.operations.settings.db", create=True)
+    def test_auto_skips_renicing_foreign_process(self, mock_db):
+        mock_db.host = "localhost"
+
+        # The reported PID belongs to a process that isn't a postgres backend,
+        # like when the server runs in a container
+        with tempfile.TemporaryDirectory() as data_directory:
+            query_results = {
+                "pg_backend_pid": [(os.getpid(),)],
+                "data_directory": [(data_directory,)],
+            }
+
+            def exec_sql(query, *args, **kwargs):
+                return next(
+                    (rows for key, rows in query_results.items() if key in query), []
+                )
+
+            with (
+                mock.patch("dslr.operations.exec_sql", new=exec_sql),
+                mock.patch("dslr.operations.exec_shell") as mock_exec_shell,
+            ):
+                self.assertFalse(operations.lower_backend_priority())
+
+        mock_exec_shell.assert_not_called()
+
+    @mock.patch("dslr.operations.settings.db", create=True)
+    @mock.patch("dslr.operations.is_local_backend", return_value=True)
+    def test_auto_renice_without_ionice(self, mock_is_local_backend, mock_db):
+        mock_db.host = "localhost"
+
+        def exec_shell(*cmd, **kwargs):
+            if cmd[0] == "ionice":
+                raise OSError("ionice not found")
+
+            return runner.Result(stdout="", stderr="")
+
+        with (
+            mock.patch("dslr.operations.exec_sql", return_value=[(1234,)]),
+            mock.patch("dslr.operations.exec_shell", new=exec_shell),
+        ):
+            self.assertTrue(operations.lower_backend_priority())
+
+    def test_auto_invalid_interval(self):
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ["auto", "--every", "soon"])
+
+        self.assertEqual(result.exit_code, 2)
+        self.assertIn('Expected a duration like "90s"', result.output)
+
     def test_restore(self):
         runner = CliRunner()
         result = runner.invoke(cli.cli, ["restore", "existing-snapshot-1"])
@@ -77,6 +523,149 @@ class CliTest(TestCase):
             "Restored database from snapshot existing-snapshot-1", result.output
         )
 
+    @mock.patch("dslr.operations.db_session")
+    @mock.patch("dslr.operations.get_snapshots")
+    def test_restore_prewarm(self, mock_get_snapshots, mock_db_session):
+        mock_get_snapshots.return_value = [
+            operations.Snapshot(
+                dbname="dslr_1577836800_my-snapshot",
+                name="my-snapshot",
+                created_at=datetime(2020, 1, 1),
+                size="100 kB",
+                tablespace="pg_default",
+                hot_relations=["users", "users_pkey", "orders"],
+            )
+        ]
+        client = mock_db_session.return_value.__enter__.return_value
+
+        def execute(query, data):
+            if "pg_extension" in query:
+                return [(True,)]
+            if "pg_size_bytes" in query:
+                return [(100,)]
+            if "unnest" in query:
+                return [("users", 60), ("users_pkey", 50), ("orders", 30)]
+            return None
+
+        client.execute.side_effect = execute
+
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ["restore", "my-snapshot", "-j", "1"])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("prewarmed 2 relations", result.output)
+        # users_pkey doesn't fit in what's left of the budget
+        self.assertEqual(
+            [
+                call.args[1]
+                for call in client.execute.call_args_list
+                if "pg_prewarm(" in call.args[0]
+            ],
+            [["users"], ["orders"]],
+        )
+
+    @mock.patch("dslr.operations.db_session")
+    @mock.patch("dslr.operations.get_snapshots")
+    def test_restore_no_prewarm(self, mock_get_snapshots, mock_db_session):
+        mock_get_snapshots.return_value = [
+            operations.Snapshot(
+                dbname="dslr_1577836800_my-snapshot",
+                name="my-snapshot",
+                created_at=datetime(2020, 1, 1),
+                size="100 kB",
+                tablespace="pg_default",
+                hot_relations=["users"],
+            )
+        ]
+
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ["restore", "my-snapshot", "--no-prewarm"])
+
+        self.assertEqual(result.exit_code, 0)
+        mock_db_session.assert_not_called()
+
+    @mock.patch("dslr.operations.kill_connections")
+    @mock.patch("dslr.operations.connect_pgbouncer")
+    def test_restore_pgbouncer(self, mock_connect_pgbouncer, mock_kill_connections):
+        client = mock_connect_pgbouncer.return_value
+
+        with mock.patch(
+            "builtins.open",
+            mock.mock_open(
+                read_data=b"pgbouncer_admin_url = "
+                b"'postgres://admin@localhost:6432/pgbouncer'"
+            ),
+        ):
+            runner = CliRunner()
+            result = runner.invoke(cli.cli, ["restore", "existing-snapshot-1"])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(
+            client.execute.call_args_list,
+            [mock.call('PAUSE "my_db"', None), mock.call('RESUME "my_db"', None)],
+        )
+        client.close.assert_called_once()
+        # Connections that bypass PgBouncer are still terminated
+        mock_kill_connections.assert_called_once_with("my_db")
+
+    @mock.patch("dslr.operations.drop_database", side_effect=RuntimeError("boom"))
+    @mock.patch("dslr.operations.connect_pgbouncer")
+    def test_restore_pgbouncer_failure(
+        self, mock_connect_pgbouncer, mock_drop_database
+    ):
+        client = mock_connect_pgbouncer.return_value
+
+        with mock.patch(
+            "builtins.open",
+            mock.mock_open(
+                read_data=b"pgbouncer_admin_url = "
+                b"'postgres://admin@localhost:6432/pgbouncer'"
+            ),
+        ):
+            runner = CliRunner()
+            result = runner.invoke(cli.cli, ["restore", "existing-snapshot-1"])
+
+        self.assertEqual(result.exit_code, 1)
+        # Clients aren't left hanging if the restore fails
+        client.execute.assert_called_with('RESUME "my_db"', None)
+
+    @mock.patch("dslr.operations.drop_database")
+    @mock.patch("dslr.operations.pgbouncer_session")
+    @mock.patch("dslr.operations.connect_pgbouncer")
+    def test_restore_pgbouncer_pause_timeout(
+        self, mock_connect_pgbouncer, mock_pgbouncer_session, mock_drop_database
+    ):
+        released = threading.Event()
+        mock_connect_pgbouncer.return_value.execute.side_effect = lambda *args: (
+            released.wait(5)
+        )
+        other_client = mock_pgbouncer_session.return_value.__enter__.return_value
+
+        try:
+            with mock.patch(
+                "builtins.open",
+                mock.mock_open(
+                    read_data=b"pgbouncer_admin_url = "
+                    b"'postgres://admin@localhost:6432/pgbouncer'\n"
+                    b"pgbouncer_pause_timeout = 0.1"
+                ),
+            ):
+                runner = CliRunner()
+                result = runner.invoke(cli.cli, ["restore", "existing-snapshot-1"])
+        finally:
+            released.set()
+
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("Timed out waiting for PgBouncer", result.output)
+        # The pause is called off from a second connection
+        other_client.execute.assert_called_once_with('RESUME "my_db"', None)
+        mock_drop_database.assert_not_called()
+
+    def test_quote_pgbouncer_identifier(self):
+        self.assertEqual(
+            operations.quote_pgbouncer_identifier('My-"DB"'), '"My-""DB"""'
+        )
+
     def test_restore_not_found(self):
         runner = CliRunner()
         result = runner.invoke(cli.cli, ["restore", "not-found"])
@@ -84,12 +673,56 @@ class CliTest(TestCase):
         self.assertEqual(result.exit_code, 1)
         self.assertIn("Snapshot not-found does not exist", result.output)
 
+    @mock.patch("dslr.operations.rename_database")
+    def test_restore_from_file(self, mock_rename_database):
+        runner = CliRunner()
+        result = runner.invoke(
+            cli.cli,
+            ["restore", "--from-file", "pyproject.toml", "--keep-as", "my-snapshot"],
+        )
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Restored database from pyproject.toml", result.output)
+        self.assertIn("Created new snapshot my-snapshot", result.output)
+        self.assertEqual(mock_rename_database.call_args.args[1], "my_db")
+
+    def test_restore_from_file_keep_as_existing(self):
+        runner = CliRunner()
+        result = runner.invoke(
+            cli.cli,
+            [
+                "restore",
+                "--from-file",
+                "pyproject.toml",
+                "--keep-as",
+                "existing-snapshot-1",
+            ],
+            input="n\n",
+        )
+
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn(
+            "Snapshot existing-snapshot-1 already exists. Overwrite?", result.output
+        )
+        self.assertNotIn("Restored database", result.output)
+
+    def test_restore_name_and_file(self):
+        runner = CliRunner()
+        result = runner.invoke(
+            cli.cli,
+            ["restore", "existing-snapshot-1", "--from-file", "pyproject.toml"],
+        )
+
+        self.assertEqual(result.exit_code, 2)
+        self.assertIn("Pass either a snapshot name or --from-file", result.output)
+
     def test_list(self):
         runner = CliRunner()
         result = runner.invoke(cli.cli, ["list"])
 
         self.assertEqual(result.exit_code, 0)
         self.assertIn("existing-snapshot-1", result.output)
+        self.assertIn("fast_disk", result.output)
 
     def test_delete(self):
         runner = CliRunner()
@@ -164,6 +797,229 @@ class CliTest(TestCase):
         self.assertEqual(result.exit_code, 1)
         self.assertIn("Snapshot not-found does not exist", result.output)
 
+    @mock.patch("dslr.operations.db_session")
+    def test_export_sample(self, mock_db_session):
+        client = mock_db_session.return_value.__enter__.return_value
+        added_rows = [3, 0]
+
+        def execute(query, data):
+            if query == operations.SAMPLE_TABLES_QUERY:
+                return [
+                    ("public", "orders", ["id", "user_id"]),
+                    ("public", "users", ["id"]),
+                ]
+            if query == operations.SAMPLE_FOREIGN_KEYS_QUERY:
+                return [("public", "orders", ["user_id"], "public", "users", ["id"])]
+            if "WITH added" in str(query):
+                return [(added_rows.pop(0),)]
+            return None
+
+        client.execute.side_effect = execute
+
+        runner = CliRunner()
+        result = runner.invoke(
+            cli.cli,
+            ["export", "existing-snapshot-1", "--sample", "5%", "--limit", "orders=10"],
+        )
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Exported snapshot existing-snapshot-1", result.output)
+
+        queries = [str(call.args[0]) for call in client.execute.call_args_list]
+        self.assertTrue(any("LIMIT" in query and "10" in query for query in queries))
+        self.assertTrue(any("TABLESAMPLE BERNOULLI" in query for query in queries))
+        # The picked rows are indexed and analyzed before following foreign keys
+        self.assertEqual(
+            sum(
+                "CREATE INDEX ON" in query and "(row_id)" in query for query in queries
+            ),
+            2,
+        )
+        self.assertFalse(any(" IN (SELECT" in query for query in queries))
+        # The foreign key is followed until no more rows are added
+        self.assertEqual(added_rows, [])
+        self.assertEqual(client.copy_to.call_count, 2)
+        self.assertEqual(client.copy_from.call_count, 2)
+
+    def test_sample_rows_follows_limits_down(self):
+        client = mock.Mock()
+        client.execute.return_value = [(0,)]
+        users, orders = ("public", "users"), ("public", "orders")
+
+        keep = operations.sample_rows(
+            client,
+            [orders, users],
+            [(orders, ["user_id"], users, ["id"])],
+            None,
+            {"users": 100},
+        )
+
+        creates = [
+            str(call.args[0])
+            for call in client.execute.call_args_list
+            if "CREATE TEMP TABLE" in str(call.args[0])
+        ]
+        # Users are picked first, then only the orders of the picked users
+        self.assertIn(repr(keep[users]), creates[0])
+        self.assertIn("LIMIT", creates[0])
+        self.assertIn(repr(keep[orders]), creates[1])
+        self.assertIn("EXISTS", creates[1])
+        self.assertIn(repr(keep[users]), creates[1])
+        self.assertNotIn("LIMIT", creates[1])
+
+    def test_sort_tables_by_dependencies(self):
+        a, b, c = ("public", "a"), ("public", "b"), ("public", "c")
+
+        self.assertEqual(
+            operations.sort_tables_by_dependencies(
+                [a, b, c],
+                [
+                    (a, ["b_id"], b, ["id"]),
+                    (b, ["c_id"], c, ["id"]),
+                    (c, ["c_id"], c, ["id"]),
+                ],
+            ),
+            [c, b, a],
+        )
+        # Tables in cycles come last
+        self.assertEqual(
+            operations.sort_tables_by_dependencies(
+                [a, b, c], [(a, ["b_id"], b, ["id"]), (b, ["a_id"], a, ["id"])]
+            ),
+            [c, a, b],
+        )
+
+    def test_export_sample_invalid(self):
+        runner = CliRunner()
+        result = runner.invoke(
+            cli.cli, ["export", "existing-snapshot-1", "--sample", "150%"]
+        )
+
+        self.assertEqual(result.exit_code, 2)
+        self.assertIn('Expected a percentage like "5%"', result.output)
+
+    @mock.patch("dslr.operations.create_database")
+    def test_export_import_bundle(self, mock_create_database):
+        runner = CliRunner()
+
+        with (
+            runner.isolated_filesystem(),
+            mock.patch("dslr.operations.exec_shell", new=stub_pg_dump),
+        ):
+            result = runner.invoke(cli.cli, ["export", "--all", "-j", "2"])
+
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("Exported 2 snapshots to snapshots_", result.output)
+
+            bundle_path = next(
+                path for path in os.listdir() if path.startswith("snapshots_")
+            )
+            result = runner.invoke(cli.cli, ["import", bundle_path, "-y"])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Imported 2 snapshots from", result.output)
+        self.assertCountEqual(
+            [call.kwargs["dbname"] for call in mock_create_database.call_args_list],
+            [
+                operations.generate_snapshot_db_name(
+                    "existing-snapshot-1", created_at=datetime(2020, 1, 1)
+                ),
+                operations.generate_snapshot_db_name(
+                    "existing-snapshot-2", created_at=datetime(2020, 1, 2)
+                ),
+            ],
+        )
+
+    def test_bundle_keeps_timestamps_across_timezones(self):
+        runner = CliRunner()
+
+        with (
+            runner.isolated_filesystem(),
+            mock.patch("dslr.operations.exec_shell", new=stub_pg_dump),
+            mock.patch.dict(os.environ, {"TZ": "UTC"}),
+        ):
+            time.tzset()
+            self.addCleanup(time.tzset)
+            dbnames = [row[0] for row in stub_exec_sql("LIKE 'dslr_%'")]
+            result = runner.invoke(cli.cli, ["export", "--all"])
+            bundle_path = next(
+                path for path in os.listdir() if path.startswith("snapshots_")
+            )
+
+            # Import on a machine in another timezone
+            os.environ["TZ"] = "America/New_York"
+            time.tzset()
+            entries = operations.read_bundle_manifest(bundle_path)
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIsNotNone(entries)
+        self.assertEqual(
+            [
+                operations.generate_snapshot_db_name(entry.name, entry.created_at)
+                for entry in entries or []
+            ],
+            dbnames,
+        )
+
+    def test_import_bundle_stages_dumps_next_to_bundle(self):
+        staged = []
+
+        def record_import(import_path, snapshot_name, **kwargs):
+            staged.append((import_path, os.listdir(os.path.dirname(import_path))))
+
+        runner = CliRunner()
+
+        with (
+            runner.isolated_filesystem() as cwd,
+            mock.patch("dslr.operations.exec_shell", new=stub_pg_dump),
+            mock.patch("dslr.operations.import_snapshot", side_effect=record_import),
+        ):
+            result = runner.invoke(cli.cli, ["export", "--all"])
+            bundle_path = next(
+                path for path in os.listdir() if path.startswith("snapshots_")
+            )
+            result = runner.invoke(cli.cli, ["import", bundle_path, "-y", "-j", "1"])
+            leftovers = os.listdir()
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(len(staged), 2)
+
+        for import_path, staged_files in staged:
+            self.assertEqual(
+                os.path.dirname(os.path.dirname(import_path)), os.path.realpath(cwd)
+            )
+            # Only the dump being imported is extracted
+            self.assertEqual(staged_files, [os.path.basename(import_path)])
+
+        self.assertEqual(leftovers, [bundle_path])
+
+    @mock.patch("dslr.cli.delete_snapshot")
+    def test_import_bundle_declined(self, mock_delete_snapshot):
+        runner = CliRunner()
+
+        with (
+            runner.isolated_filesystem(),
+            mock.patch("dslr.operations.exec_shell", new=stub_pg_dump),
+        ):
+            result = runner.invoke(cli.cli, ["export", "--all"])
+            bundle_path = next(
+                path for path in os.listdir() if path.startswith("snapshots_")
+            )
+
+            # Overwrite the first snapshot but not the second
+            result = runner.invoke(cli.cli, ["import", bundle_path], input="y\nn\n")
+
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("Snapshot existing-snapshot-2 already exists", result.output)
+        mock_delete_snapshot.assert_not_called()
+
+    def test_export_glob_no_match(self):
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ["export", "nothing-*"])
+
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("No snapshots match nothing-*", result.output)
+
     def test_import(self):
         runner = CliRunner()
         result = runner.invoke(
@@ -176,6 +1032,16 @@ class CliTest(TestCase):
             result.output,
         )
 
+    def test_import_directory_dump(self):
+        runner = CliRunner()
+
+        with runner.isolated_filesystem():
+            os.mkdir("dump")
+            result = runner.invoke(cli.cli, ["import", "dump", "imported-snapshot"])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Imported snapshot imported-snapshot from dump", result.output)
+
     def test_import_overwrite(self):
         runner = CliRunner()
         result = runner.invoke(
@@ -208,6 +1074,247 @@ class CliTest(TestCase):
             result.output,
         )
 
+    def test_import_sections(self):
+        with mock.patch("dslr.operations.exec_shell") as mock_exec_shell:
+            mock_exec_shell.return_value = runner.Result(
+                stdout=";     Format: CUSTOM\n", stderr=""
+            )
+            cli_runner = CliRunner()
+            result = cli_runner.invoke(
+                cli.cli, ["import", "pyproject.toml", "imported-snapshot", "-j", "3"]
+            )
+
+        restore_calls = [
+            call
+            for call in mock_exec_shell.call_args_list
+            if call.args[0] == "pg_restore" and "-l" not in call.args
+        ]
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(
+            [call.args[5:-1] for call in restore_calls],
+            [
+                ("--section=pre-data",),
+                ("--section=data", "--jobs=3"),
+                ("--section=post-data", "--jobs=3"),
+            ],
+        )
+        self.assertIn(
+            "-c synchronous_commit=off",
+            restore_calls[-1].kwargs["extra_env"]["PGOPTIONS"],
+        )
+        # The parallel jobs share the memory for building indexes
+        self.assertIn(
+            "-c maintenance_work_mem=512MB",
+            restore_calls[0].kwargs["extra_env"]["PGOPTIONS"],
+        )
+        self.assertIn(
+            "-c maintenance_work_mem=341MB -c max_parallel_maintenance_workers=1",
+            restore_calls[-1].kwargs["extra_env"]["PGOPTIONS"],
+        )
+        self.assertIn("post-data:", result.output)
+
+        # Planner statistics are gathered once all of the data is in
+        self.assertEqual(
+            mock_exec_shell.call_args.args[:3],
+            ("vacuumdb", "--analyze-in-stages", "--jobs=3"),
+        )
+        self.assertIn("analyze:", result.output)
+
+    def test_import_tar_dump(self):
+        with mock.patch("dslr.operations.exec_shell") as mock_exec_shell:
+            mock_exec_shell.return_value = runner.Result(
+                stdout=";     Format: TAR\n", stderr=""
+            )
+            cli_runner = CliRunner()
+            result = cli_runner.invoke(
+                cli.cli, ["import", "pyproject.toml", "imported-snapshot", "-j", "3"]
+            )
+
+        self.assertEqual(result.exit_code, 0)
+        # pg_restore can't restore tar archives with parallel jobs
+        self.assertEqual(
+            [
+                call.args[6]
+                for call in mock_exec_shell.call_args_list
+                if call.args[0] == "pg_restore" and "-l" not in call.args
+            ][1:],
+            ["--jobs=1", "--jobs=1"],
+        )
+
+    def test_import_no_analyze(self):
+        with mock.patch(
+            "dslr.operations.exec_shell", return_value=stub_exec_shell()
+        ) as mock_exec_shell:
+            runner = CliRunner()
+            result = runner.invoke(
+                cli.cli,
+                ["import", "pyproject.toml", "imported-snapshot", "--no-analyze"],
+            )
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertNotIn(
+            "vacuumdb", [call.args[0] for call in mock_exec_shell.call_args_list]
+        )
+        self.assertNotIn("analyze:", result.output)
+
+    @mock.patch("dslr.operations.rename_database")
+    @mock.patch("dslr.operations.create_database")
+    def test_import_resumable(self, mock_create_database, mock_rename_database):
+        exec_shell = RecordingExecShell()
+
+        with mock.patch("dslr.operations.exec_shell", new=exec_shell):
+            runner = CliRunner()
+            result = runner.invoke(
+                cli.cli,
+                [
+                    "import",
+                    "pyproject.toml",
+                    "imported-snapshot",
+                    "--resumable",
+                    # Keep the order of the restored entries deterministic
+                    "-j",
+                    "1",
+                ],
+            )
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(
+            exec_shell.restored,
+            [
+                "--section=pre-data",
+                "10; 0 16386 TABLE DATA public users postgres",
+                "11; 0 16390 TABLE DATA public orders postgres",
+                "12; 2606 16394 CONSTRAINT public users users_pkey postgres",
+            ],
+        )
+        self.assertIsNone(ImportJournal.load("imported-snapshot"))
+
+        # The data is loaded into a database that isn't listed as a snapshot
+        # until the import is done
+        dbname = mock_create_database.call_args.kwargs["dbname"]
+        self.assertTrue(dbname.startswith("tmp_dslr_import_"))
+        self.assertEqual(mock_rename_database.call_args.args[0], dbname)
+        self.assertRegex(
+            mock_rename_database.call_args.args[1], r"^dslr_\d+_imported-snapshot$"
+        )
+
+    def test_import_resumable_stops_after_failure(self):
+        exec_shell = RecordingExecShell()
+
+        def failing_exec_shell(*cmd, **kwargs):
+            result = exec_shell(*cmd, **kwargs)
+
+            if exec_shell.restored[-1:] == [DUMP_ENTRIES["data"].splitlines()[0]]:
+                raise RuntimeError("pg_restore failed")
+
+            return result
+
+        with mock.patch("dslr.operations.exec_shell", new=failing_exec_shell):
+            runner = CliRunner()
+            result = runner.invoke(
+                cli.cli,
+                ["import", "pyproject.toml", "imported-snapshot", "--resumable"]
+                + ["-j", "1"],
+            )
+
+        self.assertEqual(result.exit_code, 1)
+        # The queued table isn't loaded once another one has failed
+        self.assertEqual(
+            exec_shell.restored,
+            ["--section=pre-data", "10; 0 16386 TABLE DATA public users postgres"],
+        )
+
+    def test_get_table_data_entry_table(self):
+        self.assertEqual(
+            operations.get_table_data_entry_table(
+                "10; 0 16386 TABLE DATA public my table postgres"
+            ),
+            ("public", "my table"),
+        )
+        self.assertIsNone(
+            operations.get_table_data_entry_table(
+                "13; 0 0 SEQUENCE SET public users_id_seq postgres"
+            )
+        )
+
+    def test_import_resume(self):
+        ImportJournal(
+            snapshot_name="existing-snapshot-1",
+            import_path=os.path.abspath("pyproject.toml"),
+            dbname="tmp_dslr_import_existing-snapshot-1_1577836800",
+            completed=["pre-data", "data:10"],
+        ).save()
+        exec_shell = RecordingExecShell()
+
+        with (
+            mock.patch("dslr.operations.exec_shell", new=exec_shell),
+            mock.patch("dslr.operations.db_session") as mock_db_session,
+            mock.patch("dslr.operations.database_exists", return_value=True),
+            mock.patch("dslr.operations.rename_database") as mock_rename_database,
+        ):
+            runner = CliRunner()
+            result = runner.invoke(
+                cli.cli,
+                ["import", "pyproject.toml", "existing-snapshot-1", "--resumable"],
+            )
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertNotIn("Overwrite?", result.output)
+        self.assertIn("Resuming unfinished import", result.output)
+        self.assertEqual(
+            exec_shell.restored,
+            [
+                "11; 0 16390 TABLE DATA public orders postgres",
+                "12; 2606 16394 CONSTRAINT public users users_pkey postgres",
+            ],
+        )
+        # Rows the interrupted import may have committed are cleared first
+        client = mock_db_session.return_value.__enter__.return_value
+        self.assertEqual(client.execute.call_count, 1)
+        self.assertEqual(
+            client.execute.call_args.args[0],
+            operations.sql.SQL("TRUNCATE {}").format(
+                operations.sql.Identifier("public", "orders")
+            ),
+        )
+        self.assertIsNone(ImportJournal.load("existing-snapshot-1"))
+        self.assertEqual(
+            mock_rename_database.call_args.args[0],
+            "tmp_dslr_import_existing-snapshot-1_1577836800",
+        )
+
+    def test_stats(self):
+        runner = CliRunner()
+        runner.invoke(cli.cli, ["snapshot", "my-snapshot"])
+        runner.invoke(cli.cli, ["restore", "existing-snapshot-1"])
+        result = runner.invoke(cli.cli, ["stats"])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("snapshot", result.output)
+        self.assertIn("restore", result.output)
+        self.assertIn("my-snapshot", result.output)
+
+    def test_stats_json(self):
+        runner = CliRunner()
+        runner.invoke(cli.cli, ["snapshot", "my-snapshot"])
+        result = runner.invoke(cli.cli, ["stats", "--json"])
+
+        self.assertEqual(result.exit_code, 0)
+        stats = json.loads(result.output)
+        self.assertEqual(
+            [(s["database"], s["operation"], s["runs"]) for s in stats["operations"]],
+            [("my_db", "snapshot", 1)],
+        )
+        self.assertEqual(stats["slowest"][0]["strategy"], "template")
+
+    def test_stats_empty(self):
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ["stats"])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("No operations recorded yet", result.output)
+
 
 @mock.patch("dslr.cli.get_snapshots")
 class ConfigTest(TestCase):
@@ -224,6 +1331,14 @@ class ConfigTest(TestCase):
         mock_cli_settings.initialize.assert_called_once_with(
             debug=False,
             url="postgres://envvar:pw@test:5432/my_db",
+            exclude_tables=[],
+            vacuum_snapshot=False,
+            snapshot_tablespace=None,
+            wait=False,
+            lock_timeout=None,
+            prewarm_budget=None,
+            pgbouncer_admin_url=None,
+            pgbouncer_pause_timeout=30,
         )
 
     @mock.patch("dslr.cli.settings")
@@ -240,6 +1355,14 @@ class ConfigTest(TestCase):
         mock_cli_settings.initialize.assert_called_once_with(
             debug=False,
             url="postgres://toml:pw@test:5432/my_db",
+            exclude_tables=[],
+            vacuum_snapshot=False,
+            snapshot_tablespace=None,
+            wait=False,
+            lock_timeout=None,
+            prewarm_budget=None,
+            pgbouncer_admin_url=None,
+            pgbouncer_pause_timeout=30,
         )
 
     @mock.patch("dslr.cli.settings")
@@ -255,6 +1378,14 @@ class ConfigTest(TestCase):
         mock_cli_settings.initialize.assert_called_once_with(
             debug=False,
             url="postgres://cli:pw@test:5432/my_db",
+            exclude_tables=[],
+            vacuum_snapshot=False,
+            snapshot_tablespace=None,
+            wait=False,
+            lock_timeout=None,
+            prewarm_budget=None,
+            pgbouncer_admin_url=None,
+            pgbouncer_pause_timeout=30,
         )
 
     @mock.patch.dict(os.environ, {}, clear=True)
@@ -299,10 +1430,43 @@ class ConfigTest(TestCase):
             mock_cli_settings.initialize.call_args_list,
             [
                 # DATABASE_URL is present so use that
-                mock.call(debug=False, url="postgres://envvar:pw@test:5432/my_db"),
+                mock.call(
+                    debug=False,
+                    url="postgres://envvar:pw@test:5432/my_db",
+                    exclude_tables=[],
+                    vacuum_snapshot=False,
+                    snapshot_tablespace=None,
+                    wait=False,
+                    lock_timeout=None,
+                    prewarm_budget=None,
+                    pgbouncer_admin_url=None,
+                    pgbouncer_pause_timeout=30,
+                ),
                 # TOML is present, so use that over DATABASE_URL
-                mock.call(debug=False, url="postgres://toml:pw@test:5432/my_db"),
+                mock.call(
+                    debug=False,
+                    url="postgres://toml:pw@test:5432/my_db",
+                    exclude_tables=[],
+                    vacuum_snapshot=False,
+                    snapshot_tablespace=None,
+                    wait=False,
+                    lock_timeout=None,
+                    prewarm_budget=None,
+                    pgbouncer_admin_url=None,
+                    pgbouncer_pause_timeout=30,
+                ),
                 # --url is present, so use that over everything
-                mock.call(debug=False, url="postgres://cli:pw@test:5432/my_db"),
+                mock.call(
+                    debug=False,
+                    url="postgres://cli:pw@test:5432/my_db",
+                    exclude_tables=[],
+                    vacuum_snapshot=False,
+                    snapshot_tablespace=None,
+                    wait=False,
+                    lock_timeout=None,
+                    prewarm_budget=None,
+                    pgbouncer_admin_url=None,
+                    pgbouncer_pause_timeout=30,
+                ),
             ],
         )